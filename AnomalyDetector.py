@@ -20,11 +20,19 @@
 
 import abc
 import os
+import numpy
 import pandas
 import sys
 import six
 from datetime import datetime
-from util import get_probation_period, create_path
+from instrumentation import null_timer
+from NABCorpus import labelTimestamps
+from sinks import get_sink
+from util import get_probation_period, get_probation_records, create_path
+
+# Default number of records buffered in streaming mode to estimate the value
+# range before the detector is initialized
+WARMUP_RECORDS = 100
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -33,13 +41,82 @@ class AnomalyDetector(object):
     Base class for all anomaly detectors. When inheriting from this class please
     take note of which methods MUST be overridden, as documented below.
     """
-    def __init__(self, data_set, probationary_percent):
+    def __init__(self, data_set, probationary_percent, probationary_period=None,
+                 streaming=False, warmup_records=WARMUP_RECORDS):
+        """
+        @param data_set             (DataFile)  Data to score. May be None in
+                                                streaming mode.
+
+        @param probationary_percent (float)     Probationary period as a fraction
+                                                of the file length.
+
+        @param probationary_period  (int or datetime.timedelta)
+                                    Probationary period in records or in time,
+                                    instead of probationary_percent. A time is
+                                    converted to records with the median
+                                    sampling interval of the data.
+
+        @param streaming            (boolean)   Do not read the data set ahead
+                                                of scoring. The value range is
+                                                estimated from the first
+                                                warmup_records records, which are
+                                                scored 0 and replayed once the
+                                                detector is initialized.
+
+        @param warmup_records       (int)       Length of the streaming warm-up.
+        """
         self.data_set = data_set
-        self.probationary_period = get_probation_period(
-        probationary_percent, data_set.data.shape[0])
+        self.streaming = streaming
+        self.requested_probationary_period = probationary_period
+
+        # Set by enable_instrumentation()
+        self.instrumentation = None
+        self.timer = null_timer
+
+        self.warmup_records = None
+        self.warmup_timestamps = None
+        self.warmup_values = None
+
+        if streaming:
+            self.probationary_period = None
+            self.input_min = self.input_max = None
+            if probationary_period is None:
+                # Without a file length the percent applies to the longest file
+                self.requested_probationary_period = get_probation_period(
+                    probationary_percent, None)
+            if isinstance(self.requested_probationary_period, (int, float)):
+                warmup_records = min(warmup_records,
+                                     int(self.requested_probationary_period))
+            self.warmup_records = max(warmup_records, 2)
+            self.warmup_timestamps = []
+            self.warmup_values = []
+        else:
+            if probationary_period is None:
+                self.probationary_period = get_probation_period(
+                probationary_percent, data_set.getNumRecords())
+            else:
+                first_chunk = next(iter(data_set.iterChunks()))
+                self.probationary_period = get_probation_records(
+                    probationary_period, first_chunk["timestamp"].values)
 
-        self.input_min = self.data_set.data["value"].min()
-        self.input_max = self.data_set.data["value"].max()
+            self.input_min, self.input_max = self.get_value_range()
+
+    def enable_instrumentation(self, instrumentation):
+        """
+        Records the latency of every handle_batch() call and of every record
+        scored within it ("handle_batch" and "handle_record"), and the
+        detector's own timers, into the given Instrumentation. The records are
+        scored in the same batches as without instrumentation.
+
+        Detectors time their stages with
+
+            with self.timer("stage name"):
+                ...
+
+        which does nothing until instrumentation is enabled.
+        """
+        self.instrumentation = instrumentation
+        self.timer = instrumentation.timer
 
     def initialize(self):
         """
@@ -72,6 +149,135 @@ class AnomalyDetector(object):
         """
         raise NotImplementedError
 
+    def handle_batch(self, timestamps, values):
+        """
+        Returns a 2-D numpy array with one row per record, holding the same
+        values handle_record() would return for that record.
+
+        @param timestamps  (numpy.ndarray)  datetime64 timestamps of the batch.
+
+        @param values      (numpy.ndarray)  Values of the batch.
+
+        This method MAY be overridden by subclasses that can score a batch with
+        array-native code. The default falls back to handle_record(). Overrides
+        that still score the records one by one time each of them with the
+        "handle_record" timer.
+        """
+        record_timer = self.timer("handle_record")
+        scores = numpy.empty((len(values), self.get_num_scores()))
+        for j in range(len(values)):
+            input_data = {"timestamp": pandas.Timestamp(timestamps[j]),
+                          "value": values[j]}
+            with record_timer:
+                scores[j] = self.handle_record(input_data)
+        return scores
+
+    def process_batch(self, timestamps, values):
+        """
+        Scores a batch through handle_batch(), going through the warm-up first
+        in streaming mode. Returns the same array as handle_batch().
+        """
+        if self.warmup_values is None:
+            with self.timer("handle_batch"):
+                return self.handle_batch(timestamps, values)
+
+        scores = numpy.zeros((len(values), self.get_num_scores()))
+        buffered = sum(len(v) for v in self.warmup_values)
+        needed = self.warmup_records - buffered
+        self.warmup_timestamps.append(timestamps[:needed])
+        self.warmup_values.append(values[:needed])
+        if len(values) >= needed:
+            self.finish_warmup()
+            if len(values) > needed:
+                with self.timer("handle_batch"):
+                    scores[needed:] = self.handle_batch(timestamps[needed:],
+                                                        values[needed:])
+        return scores
+
+    def finish_warmup(self):
+        """
+        Ends the streaming warm-up: sets the value range and probationary period
+        from the buffered records, initializes the detector and replays the
+        buffered records through it.
+        """
+        timestamps = numpy.concatenate(self.warmup_timestamps)
+        values = numpy.concatenate(self.warmup_values)
+        self.warmup_timestamps = self.warmup_values = None
+
+        self.input_min, self.input_max = numpy.nanmin(values), numpy.nanmax(values)
+        self.probationary_period = get_probation_records(
+            self.requested_probationary_period, timestamps)
+
+        self.initialize()
+        self.handle_batch(timestamps, values)
+
+    def flush_warmup(self):
+        """
+        Ends a streaming warm-up cut short by the end of the input, so that a
+        stream shorter than warmup_records still initializes the detector from
+        the records it has. They keep their warm-up score of 0.
+        """
+        if self.warmup_values is not None and any(len(v) for v in self.warmup_values):
+            self.finish_warmup()
+
+    def get_state(self):
+        """
+        Returns the state of the detector as a dictionary of numpy arrays, see
+        save_state().
+
+        This method MAY be overridden by detectors that keep a state. Overrides
+        extend the dictionary returned by the parent class.
+        """
+        state = {}
+        for name in ("probationary_period", "input_min", "input_max"):
+            if getattr(self, name) is not None:
+                state[name] = numpy.asarray(getattr(self, name))
+        if self.warmup_values is not None and self.warmup_values:
+            state["warmup_timestamps"] = numpy.concatenate(self.warmup_timestamps)
+            state["warmup_values"] = numpy.concatenate(self.warmup_values)
+        return state
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state(). Overrides must restore what
+        their get_state() added and call the parent class.
+        """
+        for name in ("probationary_period", "input_min", "input_max"):
+            if name in state:
+                setattr(self, name, state[name].item())
+        if self.warmup_values is not None:
+            if "probationary_period" in state:
+                # The warm-up was over when the state was saved
+                self.warmup_timestamps = self.warmup_values = None
+            elif "warmup_values" in state:
+                self.warmup_timestamps = [state["warmup_timestamps"]]
+                self.warmup_values = [state["warmup_values"]]
+
+    def save_state(self, path):
+        """
+        Writes the state of the detector to a single .npz file, so that a
+        restarted detector can resume scoring with load_state() instead of
+        replaying the history.
+
+        @param path  (string or file)  Destination of the state.
+        """
+        if isinstance(path, six.string_types):
+            create_path(path)
+            with open(path, "wb") as state_file:
+                numpy.savez(state_file, **self.get_state())
+        else:
+            numpy.savez(path, **self.get_state())
+
+    def load_state(self, path):
+        """
+        Restores a state written by save_state(). It is called on a freshly
+        built detector in place of initialize().
+
+        @param path  (string or file)  Source of the state.
+        """
+        with numpy.load(path) as state:
+            self.set_state(dict(state))
+
     def get_header(self):
         """
         Gets the outputPath and all the headers needed to write the results files.
@@ -80,48 +286,127 @@ class AnomalyDetector(object):
         headers.extend(self.get_additional_headers())
         return headers
 
-    def run(self):
+    def get_num_scores(self):
         """
-        Main function that is called to collect anomaly scores for a given file.
+        Returns the number of columns handle_record() and handle_batch() produce
+        per record.
         """
-        headers = self.get_header()
+        return 1 + len(self.get_additional_headers())
 
-        rows = []
-        for i, row in self.data_set.data.iterrows():
-            input_data = row.to_dict()
-            detector_values = self.handle_record(input_data)
-            output_row = list(row) + list(detector_values)
-            rows.append(output_row)
+    def get_value_range(self):
+        """
+        Returns the (min, max) of the values of the data set.
+
+        This method MAY be overridden by detectors whose input is not the value
+        column.
+        """
+        return self.data_set.getValueRange()
+
+    def get_input_arrays(self, data=None):
+        """
+        Returns the (timestamps, values) of the data set, or of the given chunk
+        of it, as contiguous numpy arrays.
+        """
+        if data is None:
+            data = self.data_set.data
+        timestamps = numpy.ascontiguousarray(data["timestamp"].values)
+        values = numpy.ascontiguousarray(data["value"].values)
+        return timestamps, values
+
+    def score_arrays(self, timestamps, values, batch_size=1000):
+        """
+        Returns the preallocated score matrix of the given records, filled batch
+        by batch through handle_batch().
+
+        @param batch_size  (int)  Number of records handed to handle_batch() at
+                                  once. A progress dot is printed per batch.
+        """
+        scores = numpy.empty((len(values), self.get_num_scores()))
+        for start in range(0, len(values), batch_size):
+            stop = start + batch_size
+            scores[start:stop] = self.process_batch(timestamps[start:stop],
+                                                    values[start:stop])
+            if self.instrumentation is not None:
+                self.instrumentation.maybe_sample()
 
             # Progress report
-            if (i % 1000) == 0:
-                print "."
-                sys.stdout.flush()
+            print(".")
+            sys.stdout.flush()
+
+        return scores
+
+    def make_results(self, timestamps, values, scores):
+        """
+        Assembles the results DataFrame with the columns of get_header().
+        """
+        headers = self.get_header()
+        return pandas.DataFrame(
+            dict(zip(headers, [timestamps, values] + list(scores.T))),
+            columns=headers)
 
-        return pandas.DataFrame(rows, columns=headers)
+    def run(self, batch_size=1000):
+        """
+        Main function that is called to collect anomaly scores for a given file.
+        """
+        timestamps, values = self.get_input_arrays()
+        scores = self.score_arrays(timestamps, values, batch_size)
+        self.flush_warmup()
+        return self.make_results(timestamps, values, scores)
+
+    def run_chunked(self, chunk_size=None, batch_size=1000):
+        """
+        Streaming version of run(). Reads the data set chunk by chunk and yields
+        the results DataFrame of each chunk, so only one chunk of input and
+        output is in memory at a time.
+
+        @param chunk_size  (int)  Records per chunk, defaults to the chunkSize
+                                  of the data set.
+        """
+        for chunk in self.data_set.iterChunks(chunk_size):
+            timestamps, values = self.get_input_arrays(chunk)
+            scores = self.score_arrays(timestamps, values, batch_size)
+            yield self.make_results(timestamps, values, scores)
+        self.flush_warmup()
 
 
 def detect_data_set(args):
     """
     Function called in each detector process that run the detector that it is
-    given.
+    given. The results are written in the output format of the args, see
+    sinks.py. The labels of the args are the label of every record, or in
+    chunked mode the anomaly windows of the datafile, from which the labels of
+    each chunk are computed.
     """
-    (i, detector_instance, detector_name, labels, output_dir, relative_path) = args
+    (i, detector_instance, detector_name, labels, output_dir, relative_path,
+     output_format) = args
 
     relative_dir, file_name = os.path.split(relative_path)
     file_name = detector_name + "_" + file_name
     output_path = os.path.join(output_dir, detector_name, relative_dir, file_name)
-    create_path(output_path)
-
-    print "%s: Beginning detection with %s for %s" % (i, detector_name, relative_path)
-    detector_instance.initialize()
+    sink = get_sink(output_path, output_format)
 
-    results = detector_instance.run()
+    print("%s: Beginning detection with %s for %s" % (i, detector_name, relative_path))
+    if not detector_instance.streaming:
+        # In streaming mode the detector initializes itself after its warm-up
+        detector_instance.initialize()
 
-    # label=1 for relaxed windows, 0 otherwise
-    results["label"] = labels
+    with sink:
+        if detector_instance.data_set.chunkSize:
+            # Streaming mode: append the results to the output file chunk by chunk
+            for results in detector_instance.run_chunked():
+                # label=1 for relaxed windows, 0 otherwise
+                results["label"] = labelTimestamps(results["timestamp"], labels)
+                sink.write(results)
+        else:
+            results = detector_instance.run()
+            # label=1 for relaxed windows, 0 otherwise
+            results["label"] = numpy.asarray(labels, dtype=numpy.int8)
+            sink.write(results)
 
-    results.to_csv(output_path, index=False)
+    print("%s: Completed processing %s records at %s" % (i, sink.num_records, datetime.now()))
+    print("%s: Results have been written to %s" % (i, sink.path))
 
-    print "%s: Completed processing %s records at %s" % (i, len(results.index), datetime.now())
-    print "%s: Results have been written to %s" % (i, output_path)
+    if detector_instance.instrumentation is not None:
+        latency_path = os.path.splitext(output_path)[0] + "_latency.json"
+        detector_instance.instrumentation.export(latency_path)
+        print("%s: Latency histograms have been written to %s" % (i, latency_path))
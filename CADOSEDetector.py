@@ -1,4 +1,71 @@
+import heapq
+from array import array
+from collections import Counter
+
+import numpy
+
 from AnomalyDetector import AnomalyDetector
+from instrumentation import null_timer
+from rolling import ScoreHistory
+
+
+# Typecode of the integer arrays of the context memory. "q" is missing from the
+# array module of Python 2, whose "l" is a C long like the values of hash()
+try:
+    INT_TYPECODE = array("q").typecode
+except ValueError:
+    INT_TYPECODE = "l"
+# numpy type of the items of these arrays, for views of them
+INT_DTYPE = numpy.dtype(INT_TYPECODE)
+
+# Shift of the left semi-context id in the keys of the contexts, hashed into
+# ContextOperator.contextTable by multiplication with CONTEXT_HASH_MULTIPLIER,
+# keeping the top bits of the low CONTEXT_HASH_BITS bits
+CONTEXT_KEY_SHIFT = 32
+CONTEXT_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+CONTEXT_HASH_BITS = 64
+CONTEXT_HASH_MASK = 2 ** CONTEXT_HASH_BITS - 1
+
+# Offset of the facts of the active contexts, fed back as "neurons" to the
+# left semi-contexts of the next step
+NEURON_FACT_OFFSET = 2 ** 31
+
+# Contexts evicted first by each ContextOperator eviction policy:
+#     "lru"  the least recently activated
+#     "lfu"  the least often activated, the least recently on ties
+EVICTION_POLICIES = ("lru", "lfu")
+
+# Fraction of the context budget freed by every eviction, so that the memory is
+# not swept on every step once the budget is reached
+EVICTION_FRACTION = 0.1
+
+
+def packLists(lists):
+    """
+    Packs a list of integer lists into CSR-style (offsets, values) arrays, the
+    items of lists[i] being values[offsets[i]:offsets[i + 1]].
+    """
+    offsets = numpy.zeros(len(lists) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(l) for l in lists])
+    values = numpy.fromiter((v for l in lists for v in l), dtype=numpy.int64,
+                            count=offsets[-1])
+    return offsets, values
+
+
+def toArray(values, typecode=INT_TYPECODE):
+    """
+    @return : array.array of the values of a numpy array.
+    """
+    return array(typecode, numpy.ascontiguousarray(values, dtype=typecode).tobytes())
+
+
+def unpackLists(offsets, values):
+    """
+    Inverse of packLists().
+    """
+    values = values.tolist()
+    offsets = offsets.tolist()
+    return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
 
 
 class ContextOperator(object):
@@ -6,20 +73,97 @@ class ContextOperator(object):
     Contextual Anomaly Detector - Open Source Edition
     2016, Mikhail Smirnov   smirmik@gmail.com
     https://github.com/smirmik/CAD
+
+    The context memory is stored as arrays indexed by integer ids, instead of
+    one small list per semi-context and per context:
+
+        semiContextDics             sorted fact tuple -> semi-context id, the
+                                    interned facts of each side
+        semi-contexts of each side  facts, hash, length and number of crossed
+                                    facts
+        contexts                    counter, zerolevel flag and the ids of
+                                    their left and right semi-contexts
+        contextTable                open-addressing hash table of the context
+                                    ids, probed by their semi-context ids
+        factsDics                   fact -> array of the ids of the
+                                    semi-contexts holding it
+        leftContexts                left semi-context id -> array of the ids
+                                    of its contexts, in creation order
+
+    With a context budget the memory is bounded: once it holds more contexts
+    than the budget, evictContexts() drops the ones chosen by the eviction
+    policy together with the semi-contexts left without contexts. The ids of
+    the evicted contexts are reused once no left semi-context holds their
+    fact, the semi-contexts are renumbered.
     """
 
-    def __init__(self, maxLeftSemiContextsLenght):
+    def __init__(self, maxLeftSemiContextsLenght, maxContexts=None,
+                 evictionPolicy="lru"):
+
+        if evictionPolicy not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy %s, expected one of %s"
+                             % (evictionPolicy, ", ".join(EVICTION_POLICIES)))
 
         self.maxLeftSemiContextsLenght = maxLeftSemiContextsLenght
+        self.maxContexts = maxContexts
+        self.evictionPolicy = evictionPolicy
 
         self.factsDics = [{}, {}]
         self.semiContextDics = [{}, {}]
-        self.semiContValLists = [[], []]
+        self.semiContextFacts = [[], []]
+        # Hashes of the fact tuples, which order the active contexts of equal
+        # counts
+        self.semiContextHashes = [array(INT_TYPECODE), array(INT_TYPECODE)]
+        self.semiContextLengths = [array(INT_TYPECODE), array(INT_TYPECODE)]
+        self.semiContextCounts = [array(INT_TYPECODE), array(INT_TYPECODE)]
+        # Set of the facts of the last crossing, and the sorted ids of the
+        # semi-contexts it crossed
+        self.crossingFacts = [frozenset(), frozenset()]
         self.crossedSemiContextsLists = [[], []]
-        self.contextsValuesList = []
+
+        self.leftContexts = []
+        self.contextCounts = array(INT_TYPECODE)
+        self.contextZerolevels = array("b")
+        self.contextLeftIDs = array(INT_TYPECODE)
+        self.contextRightIDs = array(INT_TYPECODE)
+        # Step of the last activation, or of the creation, of every context
+        self.contextActivations = array(INT_TYPECODE)
+        # Heap of the ids of the evicted contexts, left -1 in contextLeftIDs,
+        # and sorted ids of the evicted contexts whose fact is still held by
+        # left semi-contexts, which are not reused until these are evicted
+        self.freeContextIDs = []
+        self.retiredContextIDs = []
+        self.stepNumber = 0
+        self.rebuildContextTable(0)
 
         self.newContextID = False
 
+    def addSemiContext(self, side, facts):
+        """
+        @param facts:     sorted tuple of the facts of the semi-context
+
+        @return : id of the semi-context of the facts, created if new.
+        """
+        semiContextDic = self.semiContextDics[side]
+        semiContextID = semiContextDic.get(facts)
+        if semiContextID is None:
+            semiContextID = len(semiContextDic)
+            semiContextDic[facts] = semiContextID
+            self.semiContextFacts[side].append(facts)
+            self.semiContextHashes[side].append(hash(facts))
+            self.semiContextLengths[side].append(len(facts))
+            self.semiContextCounts[side].append(0)
+            if side == 0:
+                self.leftContexts.append(array(INT_TYPECODE))
+            factsDic = self.factsDics[side]
+            for fact in facts:
+                semiContextIDs = factsDic.get(fact)
+                if semiContextIDs is None:
+                    factsDic[fact] = array(INT_TYPECODE, (semiContextID,))
+                else:
+                    semiContextIDs.append(semiContextID)
+        return semiContextID
+
     def getContextByFacts(self, newContextsList, zerolevel=0):
         """
         The function which determines by the complete facts list whether the
@@ -46,56 +190,225 @@ class ContextOperator(object):
 
         for leftFacts, rightFacts in newContextsList:
 
-            leftHash = leftFacts.__hash__()
-            rightHash = rightFacts.__hash__()
-
-            nextLeftSemiContextNumber = len(self.semiContextDics[0])
-            leftSemiContextID = self.semiContextDics[0].setdefault(
-                leftHash,
-                nextLeftSemiContextNumber
-            )
-            if leftSemiContextID == nextLeftSemiContextNumber:
-                leftSemiContVal = [[], len(leftFacts), 0, {}]
-                self.semiContValLists[0].append(leftSemiContVal)
-                for fact in leftFacts:
-                    semiContextList = self.factsDics[0].setdefault(fact, [])
-                    semiContextList.append(leftSemiContVal)
-
-            nextRightSemiContextNumber = len(self.semiContextDics[1])
-            rightSemiContextID = self.semiContextDics[1].setdefault(
-                rightHash,
-                nextRightSemiContextNumber
-            )
-            if rightSemiContextID == nextRightSemiContextNumber:
-                rightSemiContextValues = [[], len(rightFacts), 0]
-                self.semiContValLists[1].append(rightSemiContextValues)
-                for fact in rightFacts:
-                    semiContextList = self.factsDics[1].setdefault(fact, [])
-                    semiContextList.append(rightSemiContextValues)
-
-            nextFreeContextIDNumber = len(self.contextsValuesList)
-            contextID = self.semiContValLists[0][leftSemiContextID][3].setdefault(
-                rightSemiContextID,
-                nextFreeContextIDNumber
-            )
-
-            if contextID == nextFreeContextIDNumber:
+            leftSemiContextID = self.addSemiContext(0, leftFacts)
+            rightSemiContextID = self.addSemiContext(1, rightFacts)
+
+            slot = self.findContextSlot(leftSemiContextID, rightSemiContextID)
+            contextID = self.contextTable[slot]
+
+            if contextID == -1:
                 numAddedContexts += 1
-                contextValues = [0, zerolevel, leftHash, rightHash]
+                if self.freeContextIDs:
+                    contextID = heapq.heappop(self.freeContextIDs)
+                    self.contextCounts[contextID] = 0
+                    self.contextZerolevels[contextID] = zerolevel
+                    self.contextLeftIDs[contextID] = leftSemiContextID
+                    self.contextRightIDs[contextID] = rightSemiContextID
+                    self.contextActivations[contextID] = self.stepNumber
+                else:
+                    contextID = len(self.contextCounts)
+                    self.contextCounts.append(0)
+                    self.contextZerolevels.append(zerolevel)
+                    self.contextLeftIDs.append(leftSemiContextID)
+                    self.contextRightIDs.append(rightSemiContextID)
+                    self.contextActivations.append(self.stepNumber)
+                self.contextTable[slot] = contextID
+                self.leftContexts[leftSemiContextID].append(contextID)
+                numContexts = self.getNumContexts()
+                if 2 * numContexts >= len(self.contextTable):
+                    self.rebuildContextTable(numContexts)
 
-                self.contextsValuesList.append(contextValues)
                 if zerolevel:
                     self.newContextID = contextID
                     return True
-            else:
-                contextValues = self.contextsValuesList[contextID]
-
-                if zerolevel:
-                    contextValues[1] = 1
-                    return False
+            elif zerolevel:
+                self.contextZerolevels[contextID] = 1
+                return False
 
         return numAddedContexts
 
+    def getNumContexts(self):
+        """
+        @return : number of contexts in the memory, not evicted.
+        """
+        return (len(self.contextCounts) - len(self.freeContextIDs)
+                - len(self.retiredContextIDs))
+
+    def findContextSlot(self, leftSemiContextID, rightSemiContextID):
+        """
+        @return : slot of contextTable holding the context of the semi-contexts,
+                  or the empty slot where it goes.
+        """
+        contextTable = self.contextTable
+        mask = len(contextTable) - 1
+        key = (leftSemiContextID << CONTEXT_KEY_SHIFT) + rightSemiContextID
+        slot = ((key * CONTEXT_HASH_MULTIPLIER) & CONTEXT_HASH_MASK) >> self.contextTableShift
+        while True:
+            contextID = contextTable[slot]
+            if contextID == -1 or (self.contextLeftIDs[contextID] == leftSemiContextID and
+                                   self.contextRightIDs[contextID] == rightSemiContextID):
+                return slot
+            slot = (slot + 1) & mask
+
+    def rebuildContextTable(self, numContexts):
+        """
+        Builds a contextTable less than half full with the live contexts, so
+        that the probes stay short. A table slot costs one integer, against a
+        dict entry with a key and a context id object per context.
+
+        @param numContexts:     number of live contexts
+        """
+        bits = max(3, (2 * numContexts).bit_length())
+        self.contextTable = array(INT_TYPECODE, [-1]) * (1 << bits)
+        self.contextTableShift = CONTEXT_HASH_BITS - bits
+        contextRightIDs = self.contextRightIDs
+        for contextID, leftSemiContextID in enumerate(self.contextLeftIDs):
+            if leftSemiContextID != -1:
+                slot = self.findContextSlot(leftSemiContextID, contextRightIDs[contextID])
+                self.contextTable[slot] = contextID
+
+    def getState(self):
+        """
+        Packs the context memory into flat integer tables: the semi-contexts of
+        both sides with their facts and lengths, the facts of the currently
+        crossed semi-contexts, the fact to semi-context adjacency, the contexts
+        of every left semi-context and the values of every context. Evicted
+        contexts have no left semi-context and zero values.
+
+        @return : dictionary of numpy arrays
+        """
+        state = {
+            "maxLeftSemiContextsLenght": numpy.array(self.maxLeftSemiContextsLenght),
+            "maxContexts": numpy.array(-1 if self.maxContexts is None
+                                       else self.maxContexts),
+            "evictionPolicy": numpy.array(self.evictionPolicy),
+            "stepNumber": numpy.array(self.stepNumber),
+            # newContextID is False between steps, which equals context 0
+            "newContextID": numpy.array(-1 if self.newContextID is False
+                                        else self.newContextID),
+        }
+
+        for side in (0, 1):
+            state["semiContextOffsets%d" % side], state["semiContextFacts%d" % side] = (
+                packLists(self.semiContextFacts[side]))
+            state["semiContextLengths%d" % side] = numpy.array(
+                self.semiContextLengths[side], dtype=numpy.int64)
+
+            crossed = self.crossedSemiContextsLists[side]
+            state["crossedIDs%d" % side] = numpy.array(crossed, dtype=numpy.int64)
+            state["crossedOffsets%d" % side], state["crossedFacts%d" % side] = packLists(
+                [self.getCrossedFacts(side, semiContextID) for semiContextID in crossed])
+
+            facts = list(self.factsDics[side].keys())
+            state["facts%d" % side] = numpy.array(facts, dtype=numpy.int64)
+            state["factOffsets%d" % side], state["factSemiContexts%d" % side] = packLists(
+                [self.factsDics[side][fact] for fact in facts])
+
+        state["contextOffsets"], state["contextIDs"] = packLists(self.leftContexts)
+        state["contextRightIDs"] = numpy.array(self.contextRightIDs, dtype=numpy.int64)[
+            state["contextIDs"]]
+        state["contextsValues"] = numpy.column_stack((
+            numpy.array(self.contextCounts, dtype=numpy.int64),
+            numpy.array(self.contextZerolevels, dtype=numpy.int64),
+            self.getContextHashes(0),
+            self.getContextHashes(1),
+        )).reshape(-1, 4)
+        state["contextActivations"] = numpy.array(self.contextActivations,
+                                                  dtype=numpy.int64)
+        return state
+
+    def getContextHashes(self, side):
+        """
+        @return : numpy array of the hashes of the left or right semi-contexts
+                  of the contexts, 0 for the evicted ones.
+        """
+        semiContextIDs = numpy.array(self.contextLeftIDs if side == 0
+                                     else self.contextRightIDs, dtype=numpy.int64)
+        hashes = numpy.zeros(len(semiContextIDs), dtype=numpy.int64)
+        live = semiContextIDs >= 0
+        hashes[live] = numpy.array(self.semiContextHashes[side],
+                                   dtype=numpy.int64)[semiContextIDs[live]]
+        return hashes
+
+    def setState(self, state):
+        """
+        Restores the context memory from the tables of getState().
+        """
+        self.maxLeftSemiContextsLenght = state["maxLeftSemiContextsLenght"].item()
+        maxContexts = state["maxContexts"].item()
+        self.maxContexts = None if maxContexts == -1 else maxContexts
+        self.evictionPolicy = state["evictionPolicy"].item()
+        self.stepNumber = state["stepNumber"].item()
+        newContextID = state["newContextID"].item()
+        self.newContextID = False if newContextID == -1 else newContextID
+
+        for side in (0, 1):
+            self.semiContextLengths[side] = array(
+                INT_TYPECODE, state["semiContextLengths%d" % side].tolist())
+            numSemiContexts = len(self.semiContextLengths[side])
+            semiContextCounts = array(INT_TYPECODE, [0]) * numSemiContexts
+
+            crossedIDs = state["crossedIDs%d" % side].tolist()
+            crossedFacts = [tuple(facts) for facts in unpackLists(
+                state["crossedOffsets%d" % side], state["crossedFacts%d" % side])]
+            for semiContextID, facts in zip(crossedIDs, crossedFacts):
+                semiContextCounts[semiContextID] = len(facts)
+            self.semiContextCounts[side] = semiContextCounts
+            # The facts of the crossing outside of the crossed semi-contexts
+            # are not saved, and do not change their crossed facts
+            self.crossingFacts[side] = frozenset(
+                fact for facts in crossedFacts for fact in facts)
+            self.crossedSemiContextsLists[side] = crossedIDs
+
+            factSemiContexts = unpackLists(state["factOffsets%d" % side],
+                                           state["factSemiContexts%d" % side])
+            facts = state["facts%d" % side].tolist()
+            self.factsDics[side] = {
+                fact: array(INT_TYPECODE, semiContextIDs)
+                for fact, semiContextIDs in zip(facts, factSemiContexts)}
+
+            semiContextFacts = [tuple(semiContextFacts) for semiContextFacts in unpackLists(
+                state["semiContextOffsets%d" % side], state["semiContextFacts%d" % side])]
+            self.semiContextFacts[side] = semiContextFacts
+            self.semiContextDics[side] = dict(zip(semiContextFacts, range(numSemiContexts)))
+            self.semiContextHashes[side] = array(
+                INT_TYPECODE, [hash(semiContextFacts) for semiContextFacts in semiContextFacts])
+
+        rightIDs = unpackLists(state["contextOffsets"], state["contextRightIDs"])
+        contextIDs = unpackLists(state["contextOffsets"], state["contextIDs"])
+        numContexts = len(state["contextsValues"])
+        self.leftContexts = [array(INT_TYPECODE, contexts) for contexts in contextIDs]
+        self.contextLeftIDs = array(INT_TYPECODE, [-1]) * numContexts
+        self.contextRightIDs = array(INT_TYPECODE, [-1]) * numContexts
+        for leftSemiContextID, (rights, contexts) in enumerate(zip(rightIDs, contextIDs)):
+            for rightSemiContextID, contextID in zip(rights, contexts):
+                self.contextLeftIDs[contextID] = leftSemiContextID
+                self.contextRightIDs[contextID] = rightSemiContextID
+
+        contextsValues = state["contextsValues"]
+        self.contextCounts = toArray(contextsValues[:, 0])
+        self.contextZerolevels = toArray(contextsValues[:, 1], "b")
+        self.contextActivations = toArray(state["contextActivations"])
+        # In increasing order, which is a heap
+        evictedIDs = [contextID for contextID, leftSemiContextID
+                      in enumerate(self.contextLeftIDs) if leftSemiContextID == -1]
+        self.freeContextIDs = [contextID for contextID in evictedIDs
+                               if NEURON_FACT_OFFSET + contextID not in self.factsDics[0]]
+        self.retiredContextIDs = [contextID for contextID in evictedIDs
+                                  if NEURON_FACT_OFFSET + contextID in self.factsDics[0]]
+        self.rebuildContextTable(self.getNumContexts())
+
+    def getCrossedFacts(self, side, semiContextID):
+        """
+        @return : tuple of the facts of a crossed semi-context, in the order of
+                  the facts list of the crossing, which is sorted like the facts
+                  of the semi-contexts.
+        """
+        semiContextFacts = self.semiContextFacts[side][semiContextID]
+        if self.semiContextCounts[side][semiContextID] == len(semiContextFacts):
+            return semiContextFacts
+        return tuple(filter(self.crossingFacts[side].__contains__, semiContextFacts))
+
     def contextCrosser(self,
                        leftOrRight,
                        factsList,
@@ -108,23 +421,27 @@ class ContextOperator(object):
             else:
                 numNewContexts = 0
 
-        for semiContextValues in self.crossedSemiContextsLists[leftOrRight]:
-            semiContextValues[0] = []
-            semiContextValues[2] = 0
-
+        # Number of facts of the sorted factsList held by every semi-context,
+        # counted by Counter.update() over the id arrays. The crossed facts
+        # themselves are only needed for the potential new contexts,
+        # getCrossedFacts() finds them on demand
+        factsDic = self.factsDics[leftOrRight]
+        crossedCounts = Counter()
         for fact in factsList:
-            for semiContextValues in self.factsDics[leftOrRight].get(fact, []):
-                semiContextValues[0].append(fact)
-
-        newCrossedValues = []
+            semiContextIDs = factsDic.get(fact)
+            if semiContextIDs is not None:
+                crossedCounts.update(semiContextIDs)
 
-        for semiContextValues in self.semiContValLists[leftOrRight]:
-            lenSemiContextValues0 = len(semiContextValues[0])
-            semiContextValues[2] = lenSemiContextValues0
-            if lenSemiContextValues0 > 0:
-                newCrossedValues.append(semiContextValues)
+        # Only the semi-contexts crossed at the previous step and the ones
+        # reached now have a count to change, the others stay at 0
+        semiContextCounts = self.semiContextCounts[leftOrRight]
+        for semiContextID in self.crossedSemiContextsLists[leftOrRight]:
+            semiContextCounts[semiContextID] = 0
+        for semiContextID, count in crossedCounts.items():
+            semiContextCounts[semiContextID] = count
 
-        self.crossedSemiContextsLists[leftOrRight] = newCrossedValues
+        self.crossingFacts[leftOrRight] = frozenset(factsList)
+        self.crossedSemiContextsLists[leftOrRight] = sorted(crossedCounts)
 
         if leftOrRight:
             return self.updateContextsAndGetActive(newContextFlag)
@@ -162,46 +479,172 @@ class ContextOperator(object):
 
         potentialNewContexts = []
 
-        for leftSemiContVal in self.crossedSemiContextsLists[0]:
-
-            for rightSemiContextID, contextID in leftSemiContVal[3].items():
-
-                if self.newContextID != contextID:
-
-                    contextValues = self.contextsValuesList[contextID]
-                    rightSemiContVal = self.semiContValLists[1][rightSemiContextID]
-                    rightSemConVal0, rightSemConVal1, rightSemConVal2 = rightSemiContVal
-
-                    if leftSemiContVal[1] == leftSemiContVal[2]:
-
-                        numSelectedContext += 1
-
-                        if rightSemConVal2 > 0:
-
-                            if rightSemConVal1 == rightSemConVal2:
-                                contextValues[0] += 1
-                                activeContexts.append([contextID,
-                                                       contextValues[0],
-                                                       contextValues[2],
-                                                       contextValues[3]
-                                                       ])
-
-                            elif contextValues[1] and newContextFlag:
-                                if leftSemiContVal[2] <= self.maxLeftSemiContextsLenght:
-                                    leftFacts = tuple(leftSemiContVal[0])
-                                    rightFacts = tuple(rightSemConVal0)
-                                    potentialNewContexts.append(tuple([leftFacts, rightFacts]))
-
-                    elif contextValues[1] and newContextFlag and rightSemConVal2 > 0:
-                        if leftSemiContVal[2] <= self.maxLeftSemiContextsLenght:
-                            leftFacts = tuple(leftSemiContVal[0])
-                            rightFacts = tuple(rightSemConVal0)
-                            potentialNewContexts.append(tuple([leftFacts, rightFacts]))
+        self.stepNumber += 1
+        stepNumber = self.stepNumber
+
+        leftLengths = self.semiContextLengths[0]
+        leftCounts = self.semiContextCounts[0]
+        leftHashes = self.semiContextHashes[0]
+        rightLengths = self.semiContextLengths[1]
+        rightCounts = self.semiContextCounts[1]
+        rightHashes = self.semiContextHashes[1]
+        contextCounts = self.contextCounts
+        contextZerolevels = self.contextZerolevels
+        contextRightIDs = self.contextRightIDs
+        contextActivations = self.contextActivations
+        leftContexts = self.leftContexts
+        getCrossedFacts = self.getCrossedFacts
+        # False between the steps, which skips context 0 like the original
+        newContextID = self.newContextID
+        maxLeftSemiContextsLenght = self.maxLeftSemiContextsLenght
+
+        for leftSemiContextID in self.crossedSemiContextsLists[0]:
+
+            leftCount = leftCounts[leftSemiContextID]
+            leftComplete = leftLengths[leftSemiContextID] == leftCount
+            # Whether the left semi-context makes potential new contexts with
+            # the crossed right semi-contexts of zero-level contexts
+            crossable = newContextFlag and leftCount <= maxLeftSemiContextsLenght
+            if not leftComplete and not crossable:
+                continue
+            leftFacts = None
+
+            for contextID in leftContexts[leftSemiContextID]:
+
+                if newContextID == contextID:
+                    continue
+
+                rightSemiContextID = contextRightIDs[contextID]
+                rightCount = rightCounts[rightSemiContextID]
+
+                if leftComplete:
+
+                    numSelectedContext += 1
+
+                    if rightCount > 0 and rightLengths[rightSemiContextID] == rightCount:
+                        contextCounts[contextID] += 1
+                        contextActivations[contextID] = stepNumber
+                        activeContexts.append([contextID,
+                                               contextCounts[contextID],
+                                               leftHashes[leftSemiContextID],
+                                               rightHashes[rightSemiContextID]
+                                               ])
+                        continue
+
+                if crossable and rightCount > 0 and contextZerolevels[contextID]:
+                    if leftFacts is None:
+                        leftFacts = getCrossedFacts(0, leftSemiContextID)
+                    rightFacts = getCrossedFacts(1, rightSemiContextID)
+                    potentialNewContexts.append((leftFacts, rightFacts))
 
         self.newContextID = False
 
         return activeContexts, numSelectedContext, potentialNewContexts
 
+    def evictContexts(self):
+        """
+        Evicts contexts once there are more than maxContexts of them, down to
+        (1 - EVICTION_FRACTION) of the budget, in the order of the eviction
+        policy, then the semi-contexts left without contexts. To be called
+        between steps.
+
+        The fact of an evicted context stays in the left semi-contexts holding
+        it, which can no longer be complete. Its id is retired instead of
+        reused until these semi-contexts are evicted in turn, so that the
+        eviction stops at the contexts chosen by the policy instead of
+        cascading through the contexts of these semi-contexts.
+
+        @return : set of the facts of the evicted contexts.
+        """
+        numContexts = self.getNumContexts()
+        if self.maxContexts is None or numContexts <= self.maxContexts:
+            return set()
+
+        leftIDs = numpy.array(self.contextLeftIDs, dtype=numpy.int64)
+        rightIDs = numpy.array(self.contextRightIDs, dtype=numpy.int64)
+        activations = numpy.array(self.contextActivations, dtype=numpy.int64)
+        live = numpy.flatnonzero(leftIDs >= 0)
+        if self.evictionPolicy == "lru":
+            order = numpy.lexsort((live, activations[live]))
+        else:
+            counts = numpy.array(self.contextCounts, dtype=numpy.int64)
+            order = numpy.lexsort((live, activations[live], counts[live]))
+        numEvicted = numContexts - int(self.maxContexts * (1 - EVICTION_FRACTION))
+        evicted = numpy.zeros(len(leftIDs), dtype=bool)
+        evicted[live[order[:numEvicted]]] = True
+
+        kept = (leftIDs >= 0) & ~evicted
+        alive = [
+            numpy.bincount(leftIDs[kept], minlength=len(self.semiContextLengths[0])) > 0,
+            numpy.bincount(rightIDs[kept], minlength=len(self.semiContextLengths[1])) > 0,
+        ]
+        newIDs = [self.renumberSemiContexts(side, alive[side]) for side in (0, 1)]
+
+        evictedIDs = numpy.flatnonzero(evicted)
+        self.leftContexts = [
+            toArray(contexts[~evicted[contexts]])
+            for contexts in (numpy.frombuffer(contexts, dtype=INT_DTYPE)
+                             for contexts, isAlive in zip(self.leftContexts, alive[0].tolist())
+                             if isAlive)]
+        leftIDs = numpy.where(kept, newIDs[0][leftIDs], -1)
+        rightIDs = numpy.where(kept, newIDs[1][rightIDs], -1)
+        self.contextLeftIDs = toArray(leftIDs)
+        self.contextRightIDs = toArray(rightIDs)
+        for contextID in evictedIDs.tolist():
+            self.contextCounts[contextID] = 0
+            self.contextZerolevels[contextID] = 0
+            self.contextActivations[contextID] = 0
+
+        # The renumbering dropped the facts held by no semi-context anymore
+        retired = list(heapq.merge(self.retiredContextIDs, evictedIDs.tolist()))
+        factsDic = self.factsDics[0]
+        self.retiredContextIDs = [contextID for contextID in retired
+                                  if NEURON_FACT_OFFSET + contextID in factsDic]
+        self.freeContextIDs = list(heapq.merge(
+            self.freeContextIDs, [contextID for contextID in retired
+                                  if NEURON_FACT_OFFSET + contextID not in factsDic]))
+        self.rebuildContextTable(int(kept.sum()))
+
+        return set((evictedIDs + NEURON_FACT_OFFSET).tolist())
+
+    def renumberSemiContexts(self, side, alive):
+        """
+        Drops the semi-contexts of a side that are not alive and numbers the
+        others consecutively, in their previous order.
+
+        @param alive:     numpy boolean array, by semi-context id
+
+        @return : numpy array of the new id of every previous semi-context,
+                  -1 for the dropped ones.
+        """
+        newIDs = numpy.cumsum(alive) - 1
+        newIDs[~alive] = -1
+
+        self.semiContextFacts[side] = [
+            facts for facts, isAlive in zip(self.semiContextFacts[side], alive.tolist())
+            if isAlive]
+        self.semiContextHashes[side] = toArray(
+            numpy.array(self.semiContextHashes[side], dtype=numpy.int64)[alive])
+        self.semiContextDics[side] = dict(
+            (facts, newID) for newID, facts in enumerate(self.semiContextFacts[side]))
+        self.semiContextLengths[side] = toArray(
+            numpy.array(self.semiContextLengths[side], dtype=numpy.int64)[alive])
+        self.semiContextCounts[side] = toArray(
+            numpy.array(self.semiContextCounts[side], dtype=numpy.int64)[alive])
+
+        factsDic = {}
+        for fact, semiContextIDs in self.factsDics[side].items():
+            semiContextIDs = newIDs[numpy.frombuffer(semiContextIDs, dtype=INT_DTYPE)]
+            semiContextIDs = semiContextIDs[semiContextIDs >= 0]
+            if len(semiContextIDs):
+                factsDic[fact] = toArray(semiContextIDs)
+        self.factsDics[side] = factsDic
+
+        crossed = [semiContextID for semiContextID in self.crossedSemiContextsLists[side]
+                   if alive[semiContextID]]
+        self.crossedSemiContextsLists[side] = newIDs[crossed].tolist()
+
+        return newIDs
 
 
 class ContextualAnomalyDetectorOSE(object):
@@ -218,7 +661,10 @@ class ContextualAnomalyDetectorOSE(object):
                  restPeriod = 30,
                  maxLeftSemiContextsLenght = 7,
                  maxActiveNeuronsNum = 15,
-                 numNormValueBits = 3 ):
+                 numNormValueBits = 3,
+                 rangePadding = 0.2,
+                 maxContexts = None,
+                 evictionPolicy = "lru" ):
 
         self.minValue = float(minValue)
         self.maxValue = float(maxValue)
@@ -226,20 +672,22 @@ class ContextualAnomalyDetectorOSE(object):
         self.baseThreshold = baseThreshold
         self.maxActNeurons = maxActiveNeuronsNum
         self.numNormValueBits = numNormValueBits
+        self.rangePadding = rangePadding
 
         self.maxBinValue = 2 ** self.numNormValueBits - 1.0
-        self.fullValueRange = self.maxValue - self.minValue
-        if self.fullValueRange == 0.0:
-            self.fullValueRange = self.maxBinValue
-        self.minValueStep = self.fullValueRange / self.maxBinValue
+        self.setValueRange(self.minValue, self.maxValue)
 
         self.leftFactsGroup = tuple()
 
-        self.contextOperator = ContextOperator(maxLeftSemiContextsLenght)
+        self.contextOperator = ContextOperator(maxLeftSemiContextsLenght,
+                                               maxContexts, evictionPolicy)
 
         self.potentialNewContexts = []
 
-        self.aScoresHistory = [1.0]
+        self.aScoresHistory = self.newScoresHistory([1.0])
+
+        # Replaced by the timer of an instrumented ContextOSEDetector
+        self.timer = null_timer
 
 
     def step(self, inpFacts):
@@ -256,10 +704,11 @@ class ContextualAnomalyDetectorOSE(object):
         else:
             newContextFlag = False
 
-        leftCrossing = self.contextOperator.contextCrosser(
-            leftOrRight=1,
-            factsList=currSensFacts,
-            newContextFlag=newContextFlag)
+        with self.timer("leftCrosser"):
+            leftCrossing = self.contextOperator.contextCrosser(
+                leftOrRight=1,
+                factsList=currSensFacts,
+                newContextFlag=newContextFlag)
         activeContexts, numSelContexts, potNewContexts = leftCrossing
 
         uniqPotNewContexts.update(potNewContexts)
@@ -273,19 +722,25 @@ class ContextualAnomalyDetectorOSE(object):
         srtAContexts = sorted(activeContexts, key=lambda x: (x[1], x[2], x[3]))
         activeNeurons = [cInf[0] for cInf in srtAContexts[-self.maxActNeurons:]]
 
-        currNeurFacts = set([2 ** 31 + fact for fact in activeNeurons])
+        currNeurFacts = set([NEURON_FACT_OFFSET + fact for fact in activeNeurons])
 
         leftFactsGroup = set()
         leftFactsGroup.update(currSensFacts, currNeurFacts)
         self.leftFactsGroup = tuple(sorted(leftFactsGroup))
 
-        numNewCont = self.contextOperator.contextCrosser(
-            leftOrRight=0,
-            factsList=self.leftFactsGroup,
-            potentialNewContexts=potNewContexts)
+        with self.timer("rightCrosser"):
+            numNewCont = self.contextOperator.contextCrosser(
+                leftOrRight=0,
+                factsList=self.leftFactsGroup,
+                potentialNewContexts=potNewContexts)
 
         numNewCont += 1 if newContextFlag else 0
 
+        evictedFacts = self.contextOperator.evictContexts()
+        if evictedFacts:
+            self.leftFactsGroup = tuple(fact for fact in self.leftFactsGroup
+                                        if fact not in evictedFacts)
+
         if newContextFlag and numUniqPotNewContext > 0:
             percentAddedContextToUniqPotNew = numNewCont / float(numUniqPotNewContext)
         else:
@@ -293,8 +748,81 @@ class ContextualAnomalyDetectorOSE(object):
 
         return percentSelectedContextActive, percentAddedContextToUniqPotNew
 
+    def getState(self):
+        """
+        @return : dictionary of numpy arrays holding the parameters, the
+                  history and the context memory of the detector
+        """
+        state = self.contextOperator.getState()
+        state["valueRange"] = numpy.array([self.minValue, self.maxValue])
+        state["parameters"] = numpy.array([self.restPeriod,
+                                           self.baseThreshold,
+                                           self.maxActNeurons,
+                                           self.numNormValueBits,
+                                           self.rangePadding])
+        state["leftFactsGroup"] = numpy.array(self.leftFactsGroup, dtype=numpy.int64)
+        state["aScoresHistory"] = numpy.array(self.aScoresHistory.to_list())
+        return state
+
+    def setState(self, state):
+        """
+        Restores a state returned by getState().
+        """
+        self.contextOperator.setState(state)
+        (self.restPeriod, self.baseThreshold, maxActNeurons, numNormValueBits,
+         self.rangePadding) = state["parameters"].tolist()
+        self.maxActNeurons = int(maxActNeurons)
+        self.numNormValueBits = int(numNormValueBits)
+        self.maxBinValue = 2 ** self.numNormValueBits - 1.0
+        self.setValueRange(*state["valueRange"].tolist())
+        self.leftFactsGroup = tuple(state["leftFactsGroup"].tolist())
+        self.aScoresHistory = self.newScoresHistory(state["aScoresHistory"].tolist())
+
+    def newScoresHistory(self, scores):
+        """
+        @return : ScoreHistory of the scores that the rest period looks back
+                  on, all of them for a rest period under 1 like the unbounded
+                  history.
+        """
+        return ScoreHistory(int(self.restPeriod) or None, scores)
+
     def getAnomalyScore(self, inputData):
-        normInpVal = int((inputData["value"] - self.minValue) / self.minValueStep)
+        return self.getAnomalyScoreByValue(inputData["value"])
+
+    def setValueRange(self, minValue, maxValue):
+        self.minValue = minValue
+        self.maxValue = maxValue
+        self.fullValueRange = self.maxValue - self.minValue
+        if self.fullValueRange == 0.0:
+            self.fullValueRange = self.maxBinValue
+        self.minValueStep = self.fullValueRange / self.maxBinValue
+
+    def rebaseValueRange(self, value):
+        """
+        Grows the value range to cover a value outside of it, which happens in
+        streaming mode where the range is only estimated during a warm-up. The
+        range is padded on the side it grows by rangePadding of the new range,
+        so that a slowly drifting series does not rebase on every record.
+        Contexts learned before keep their facts, only the binning of the new
+        values changes.
+
+        @param value:     the value that fell outside of the range
+        """
+        minValue = min(self.minValue, value)
+        maxValue = max(self.maxValue, value)
+        padding = (maxValue - minValue) * self.rangePadding
+        if value < self.minValue:
+            minValue -= padding
+        else:
+            maxValue += padding
+        self.setValueRange(minValue, maxValue)
+
+    def getAnomalyScoreByValue(self, value):
+        if value < self.minValue or value > self.maxValue:
+            self.rebaseValueRange(value)
+
+        normInpVal = int((value - self.minValue) / self.minValueStep)
+        normInpVal = min(normInpVal, int(self.maxBinValue))
         binInpValue = bin(normInpVal).lstrip("0b").rjust(self.numNormValueBits, "0")
 
         outSens = []
@@ -305,7 +833,7 @@ class ContextualAnomalyDetectorOSE(object):
         anomalyVal1, anomalyVal2 = self.step(setOutSens)
         currentAnomalyScore = (1.0 - anomalyVal1 + anomalyVal2) / 2.0
 
-        if max(self.aScoresHistory[-int(self.restPeriod):]) < self.baseThreshold:
+        if self.aScoresHistory.max() < self.baseThreshold:
             returnedAnomalyScore = currentAnomalyScore
         else:
             returnedAnomalyScore = 0.0
@@ -323,6 +851,10 @@ class ContextOSEDetector(AnomalyDetector):
     """
 
     def __init__(self, *args, **kwargs):
+        # Budget of contexts in the memory of CAD-OSE, unbounded by default,
+        # and the policy choosing the ones evicted beyond it
+        self.max_contexts = kwargs.pop("max_contexts", None)
+        self.eviction_policy = kwargs.pop("eviction_policy", "lru")
         super(ContextOSEDetector, self).__init__(*args, **kwargs)
 
         self.cadose = None
@@ -331,9 +863,33 @@ class ContextOSEDetector(AnomalyDetector):
         anomalyScore = self.cadose.getAnomalyScore(inputData)
         return (anomalyScore,)
 
+    def handle_batch(self, timestamps, values):
+        getAnomalyScoreByValue = self.cadose.getAnomalyScoreByValue
+        record_timer = self.timer("handle_record")
+        scores = numpy.empty((len(values), 1))
+        for j, value in enumerate(values):
+            with record_timer:
+                scores[j, 0] = getAnomalyScoreByValue(value)
+        return scores
+
+    def get_state(self):
+        state = super(ContextOSEDetector, self).get_state()
+        if self.cadose is not None:
+            state.update(self.cadose.getState())
+        return state
+
+    def set_state(self, state):
+        super(ContextOSEDetector, self).set_state(state)
+        if "contextsValues" in state:
+            self.initialize()
+            self.cadose.setState(state)
+
     def initialize(self):
         self.cadose = ContextualAnomalyDetectorOSE(
             minValue=self.input_min,
             maxValue=self.input_max,
             restPeriod=self.probationary_period / 5.0,
+            maxContexts=self.max_contexts,
+            evictionPolicy=self.eviction_policy,
         )
+        self.cadose.timer = self.timer
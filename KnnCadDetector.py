@@ -1,64 +1,312 @@
 from AnomalyDetector import AnomalyDetector
+from neighbours import get_neighbour_index, get_whitening
+from rolling import RankedWindow, RingBuffer
 
 import numpy as np
 import math
+import pandas
+
+
+# Memory bound of the distance blocks of bulk_ncm()
+NCM_BLOCK_BYTES = 32 * 2 ** 20
+
+# Ridge added to a singular Gram matrix, relative to its mean eigenvalue
+GRAM_REGULARIZATION = 1e-9
+
+# Smallest denominator of a rank-one downdate of sigma before it is
+# recomputed from scratch instead
+DOWNDATE_TOLERANCE = 1e-8
+
+
+def invert_gram(gram):
+    """
+    @return (numpy.ndarray)  Inverse of a Gram matrix, regularized with a small
+                             ridge if it is singular.
+    """
+    try:
+        return np.linalg.inv(gram)
+    except np.linalg.LinAlgError:
+        ridge = GRAM_REGULARIZATION * max(np.trace(gram) / len(gram), 1.0)
+        return np.linalg.inv(gram + ridge * np.eye(len(gram)))
+
+
+def bulk_ncm(training, sigma, items, k, self_rows=None):
+    """
+    Nonconformity of many items at once. The pairwise distances to the
+    training vectors are expanded as q_i + q_j - 2 x_i.sigma.x_j^T, so each
+    block of items costs a single matrix product.
+
+    @param training   (numpy.ndarray)  Training vectors as rows.
+
+    @param sigma      (numpy.ndarray)  Matrix of the Mahalanobis metric.
+
+    @param items      (numpy.ndarray)  Items as rows.
+
+    @param k          (int)            Number of nearest neighbours summed.
+
+    @param self_rows  (numpy.ndarray)  For each item, the training row it is
+                                       or -1. The distance to itself is then
+                                       exactly 0 and counted as in
+                                       ncm(item, True).
+
+    @return           (numpy.ndarray)  The NCM of every item.
+    """
+    dim = training.shape[1]
+    # Distances do not depend on the origin, centering keeps the expansion
+    # from cancelling out
+    center = training.mean(axis=0)
+    training = training - center
+    items = np.asarray(items, dtype=float).reshape(-1, dim) - center
+    sigma = (sigma + sigma.T) / 2
+
+    training_sq = np.einsum("ij,ij->i", np.dot(training, sigma), training)
+    ncms = np.empty(len(items))
+    block_size = max(1, NCM_BLOCK_BYTES // (8 * len(training)))
+    for start in range(0, len(items), block_size):
+        block = items[start:start + block_size]
+        weighted = np.dot(block, sigma)
+        distances = np.dot(weighted, training.T)
+        distances *= -2
+        distances += training_sq
+        distances += np.einsum("ij,ij->i", weighted, block)[:, None]
+        np.maximum(distances, 0, out=distances)
+
+        num_neighbours = np.full(len(block), k)
+        if self_rows is not None:
+            rows = np.flatnonzero(self_rows[start:start + block_size] >= 0)
+            distances[rows, self_rows[start:start + block_size][rows]] = 0
+            num_neighbours[rows] += 1
+        for kk in np.unique(num_neighbours):
+            rows = np.flatnonzero(num_neighbours == kk)
+            ncms[start + rows] = np.partition(distances[rows], kk - 1, axis=1)[:, :kk].sum(axis=1)
+    return ncms
 
 
 class KnncadDetector(AnomalyDetector):
 
     def __init__(self, *args, **kwargs):
+        # Recompute the calibration scores whenever sigma is refreshed
+        self.recalibrate = kwargs.pop("recalibrate", False)
+        # Update sigma on every change of the training set instead of twice
+        # per probationary period
+        self.track_sigma = kwargs.pop("track_sigma", False)
+        # Name of a neighbours.NEIGHBOUR_INDEXES to find the nearest training
+        # vectors with, instead of scanning them all
+        neighbour_index = kwargs.pop("neighbour_index", None)
+        neighbour_eps = kwargs.pop("neighbour_eps", 0.0)
+        if neighbour_index and self.track_sigma:
+            # A new sigma whitens the vectors again, which would rebuild the
+            # index on every record
+            raise ValueError("track_sigma cannot be combined with a neighbour index")
+        self.neighbour_index = (get_neighbour_index(neighbour_index, neighbour_eps)
+                                if neighbour_index else None)
         super(KnncadDetector, self).__init__(*args, **kwargs)
 
-        self.buf = []
-        self.training = []
-        self.calibration = []
-        self.scores = []
         self.record_count = 0
         self.pred = -1
         self.k = 27
         self.dim = 19
         self.sigma = np.diag(np.ones(self.dim))
 
+        # Last dim values, the window of the current item
+        self.buf = RingBuffer(self.dim)
+        # List of the training vectors during the probationary period, then a
+        # 2-D array whose oldest row is at training_head, see freeze_training()
+        self.training = []
+        self.training_head = 0
+        # RingBuffer of the items scored since, see freeze_training()
+        self.calibration = None
+        self.scores = RankedWindow()
+
+    def get_state(self):
+        state = super(KnncadDetector, self).get_state()
+        state["buf"] = self.buf.to_array()
+        state["training"] = self.get_training()
+        state["calibration"] = (self.calibration.to_array() if self.calibration is not None
+                                else np.empty((0, self.dim)))
+        state["scores"] = np.array(self.scores.to_list(), dtype=float)
+        state["sigma"] = self.sigma
+        state["counters"] = np.array([self.record_count, self.pred, self.k, self.dim])
+        return state
+
+    def set_state(self, state):
+        super(KnncadDetector, self).set_state(state)
+        self.record_count, self.pred, self.k, self.dim = state["counters"].tolist()
+        self.buf = RingBuffer(self.dim)
+        self.buf.extend(state["buf"])
+        # Frozen again on the next scored record
+        self.training = list(state["training"])
+        self.training_head = 0
+        self.calibration = None
+        if len(state["calibration"]):
+            self.calibration = self.new_calibration()
+            self.calibration.extend(state["calibration"])
+        self.scores = RankedWindow(state["scores"].tolist())
+        self.sigma = state["sigma"]
+
     def metric(self, a, b):
         diff = a - np.array(b)
         return np.dot(np.dot(diff, self.sigma), diff.T)
 
+    def get_training(self):
+        """
+        @return (numpy.ndarray)  Training vectors, oldest first.
+        """
+        if isinstance(self.training, list):
+            return np.array(self.training, dtype=float).reshape(-1, self.dim)
+        return np.roll(self.training, -self.training_head, axis=0)
+
+    def freeze_training(self):
+        """
+        Turns the training vectors into a contiguous 2-D array once the
+        probationary period is over. From then on the training set slides by
+        overwriting its oldest row.
+        """
+        self.training = self.get_training()
+        self.training_head = 0
+        if self.calibration is None:
+            self.calibration = self.new_calibration()
+        if self.neighbour_index is not None:
+            self.neighbour_index.build(self.training, self.sigma)
+
+    def new_calibration(self):
+        """
+        @return (RingBuffer)  Empty calibration set. It holds the items of at
+                              most one probationary period, as its oldest item
+                              moves to the training set from then on.
+        """
+        return RingBuffer(int(self.probationary_period) + 1, self.dim)
+
     def ncm(self, item, item_in_array=False):
-        arr = [self.metric(x, item) for x in self.training]
+        """
+        Nonconformity of an item, the sum of its k smallest Mahalanobis
+        distances to the training vectors, all evaluated at once.
+        """
+        if self.neighbour_index is not None and not item_in_array:
+            return self.neighbour_index.ncm(item, self.k)
+
+        diff = self.training - np.asarray(item, dtype=float)
+        arr = np.einsum("ij,ij->i", np.dot(diff, self.sigma), diff)
         return np.sum(np.partition(arr, self.k + item_in_array)[:self.k + item_in_array])
 
+    def compute_sigma(self):
+        """
+        @return (numpy.ndarray)  Inverse of the Gram matrix of the training
+                                 vectors. A singular Gram matrix is regularized
+                                 with a small ridge.
+        """
+        training = self.get_training()
+        return invert_gram(np.dot(training.T, training))
+
+    def update_sigma(self, removed, added):
+        """
+        Updates sigma for a training vector replaced by another one, with a
+        Sherman-Morrison update for the added vector followed by a downdate
+        for the removed one, in O(dim^2). Falls back to compute_sigma() when
+        the downdate is ill-conditioned. The training set must already hold
+        the added vector.
+        """
+        weighted = np.dot(self.sigma, added)
+        sigma = self.sigma - np.outer(weighted, weighted) / (1 + np.dot(added, weighted))
+
+        weighted = np.dot(sigma, removed)
+        denominator = 1 - np.dot(removed, weighted)
+        if denominator < DOWNDATE_TOLERANCE:
+            self.sigma = self.compute_sigma()
+        else:
+            self.sigma = sigma + np.outer(weighted, weighted) / denominator
+
+    def bulk_ncm(self, items, self_rows=None):
+        """
+        Nonconformity of many items at once, see bulk_ncm().
+        """
+        return bulk_ncm(self.training, self.sigma, items, self.k, self_rows)
+
+    def calibrate(self):
+        """
+        Computes self.scores in bulk. The first time they are the NCMs of the
+        training vectors. Afterwards the items the scores belong to are scored
+        again under the current sigma: the most recent calibration vectors, and
+        the training vectors whose scores are not replaced yet.
+        """
+        num_training = len(self.training)
+        if len(self.scores) == 0:
+            items = self.get_training()
+            self_rows = (np.arange(num_training) + self.training_head) % num_training
+        else:
+            num_scores = len(self.scores)
+            num_calibration = min(len(self.calibration), num_scores)
+            logical_rows = np.arange(num_training - (num_scores - num_calibration),
+                                     num_training)
+            self_rows = (logical_rows + self.training_head) % num_training
+            items = self.training[self_rows]
+            if num_calibration:
+                items = np.concatenate((items, self.calibration.get_window(num_calibration)))
+                self_rows = np.concatenate((self_rows, np.full(num_calibration, -1)))
+        self.scores = RankedWindow(self.bulk_ncm(items, self_rows).tolist())
+
     def handle_record(self, input_data):
         """
         inputRow = [inputData["timestamp"], inputData["value"]]
         """
-        self.buf.append(input_data['value'])
+        return self.handle_value(input_data['value'])
+
+    def handle_batch(self, timestamps, values):
+        record_timer = self.timer("handle_record")
+        scores = np.empty((len(values), 1))
+        for j, value in enumerate(values):
+            with record_timer:
+                scores[j] = self.handle_value(value)
+        return scores
+
+    def handle_value(self, value):
+        """
+        Scores a single value of the stream and returns a list [anomalyScore].
+        """
+        self.buf.append(value)
         self.record_count += 1
 
         if len(self.buf) < self.dim:
             return [0.0]
         else:
-            new_item = self.buf[-self.dim:]
+            new_item = self.buf.get_window()
             if self.record_count < self.probationary_period:
-                self.training.append(new_item)
+                self.training.append(new_item.copy())
                 return [0.0]
             else:
+                if isinstance(self.training, list):
+                    self.freeze_training()
+
                 ost = self.record_count % self.probationary_period
                 if ost == 0 or ost == int(self.probationary_period / 2):
-                    try:
-                        self.sigma = np.linalg.inv(np.dot(np.array(self.training).T, self.training))
-                    except np.linalg.linalg.LinAlgError:
-                        print('Singular Matrix at record', self.record_count)
+                    # With track_sigma this refresh also clears the rounding
+                    # errors accumulated by the updates
+                    self.sigma = self.compute_sigma()
+                    if self.neighbour_index is not None:
+                        self.neighbour_index.set_sigma(self.sigma)
+                    if self.recalibrate and len(self.scores):
+                        with self.timer("calibration"):
+                            self.calibrate()
                 if len(self.scores) == 0:
-                    self.scores = [self.ncm(v, True) for v in self.training]
+                    with self.timer("calibration"):
+                        self.calibrate()
 
-                new_score = self.ncm(new_item)
-                result = 1. * len(np.where(np.array(self.scores) < new_score)[0]) / len(self.scores)
+                with self.timer("ncm"):
+                    new_score = self.ncm(new_item)
+                result = 1. * self.scores.rank(new_score) / len(self.scores)
 
                 if self.record_count >= 2 * self.probationary_period:
-                    self.training.pop(0)
-                    self.training.append(self.calibration.pop(0))
+                    # Replace the oldest training vector
+                    removed = self.training[self.training_head].copy()
+                    self.training[self.training_head] = self.calibration.popleft()
+                    if self.neighbour_index is not None:
+                        self.neighbour_index.replace(self.training_head,
+                                                     self.training[self.training_head])
+                    if self.track_sigma:
+                        self.update_sigma(removed, self.training[self.training_head])
+                    self.training_head = (self.training_head + 1) % len(self.training)
 
-                self.scores.pop(0)
+                self.scores.popleft()
                 self.calibration.append(new_item)
                 self.scores.append(new_score)
 
@@ -68,3 +316,232 @@ class KnncadDetector(AnomalyDetector):
                 elif result >= 0.9965:
                     self.pred = int(self.probationary_period / 5)
                 return [result]
+
+
+class MultiStreamKnncadDetector(AnomalyDetector):
+    """
+    KNN-CAD over many streams sharing the same timestamps, e.g. the metrics of
+    a fleet of hosts. The data set holds one value column per stream, and the
+    state of all the streams is stacked in arrays, so that each record of all
+    the streams is scored in a single vectorized step. Every stream gets the
+    scores a KnncadDetector would give it alone, up to rounding: the distances
+    are computed between training vectors whitened by a factor of sigma, which
+    costs O(dim) per vector instead of O(dim^2).
+
+    The results hold one value and one <stream>_anomaly_score column per
+    stream.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Names of the value columns of the streams, all the non-timestamp
+        # columns of the data set by default
+        self.value_columns = kwargs.pop("value_columns", None)
+        super(MultiStreamKnncadDetector, self).__init__(*args, **kwargs)
+
+        if self.value_columns is None:
+            if self.data_set is None:
+                raise ValueError("value_columns is required without a data set")
+            columns = pandas.read_csv(self.data_set.srcPath, nrows=0).columns
+            self.value_columns = [c for c in columns if c != "timestamp"]
+        self.num_streams = len(self.value_columns)
+
+        self.record_count = 0
+        self.k = 27
+        self.dim = 19
+        self.pred = np.full(self.num_streams, -1)
+        self.sigma = np.tile(np.eye(self.dim), (self.num_streams, 1, 1))
+        # Factors L of sigma = L.L^T of every stream and the training vectors
+        # multiplied by them, see set_sigma()
+        self.whitening = None
+        self.whitened = None
+
+        # Last dim records of every stream
+        self.buf = RingBuffer(self.dim, self.num_streams)
+        # List of (streams x dim) items during the probationary period, then
+        # a (streams x vectors x dim) array whose oldest vectors are at
+        # training_head
+        self.training = []
+        self.training_head = 0
+        self.calibration = None
+        # (streams x vectors) FIFO of the scores, oldest at scores_head
+        self.scores = None
+        self.scores_head = 0
+
+    def get_value_range(self):
+        # Not used by KNN-CAD
+        return None, None
+
+    def get_input_arrays(self, data=None):
+        if data is None:
+            data = self.data_set.data
+        timestamps = np.ascontiguousarray(data["timestamp"].values)
+        values = np.ascontiguousarray(data[self.value_columns].values, dtype=float)
+        return timestamps, values
+
+    def get_header(self):
+        return (["timestamp"] + list(self.value_columns)
+                + ["%s_anomaly_score" % column for column in self.value_columns])
+
+    def get_num_scores(self):
+        return self.num_streams
+
+    def make_results(self, timestamps, values, scores):
+        headers = self.get_header()
+        return pandas.DataFrame(
+            dict(zip(headers, [timestamps] + list(values.T) + list(scores.T))),
+            columns=headers)
+
+    def handle_record(self, input_data):
+        """
+        input_data["value"] holds the values of all the streams.
+        """
+        return self.handle_values(np.asarray(input_data["value"], dtype=float))
+
+    def handle_batch(self, timestamps, values):
+        record_timer = self.timer("handle_record")
+        scores = np.empty((len(values), self.num_streams))
+        for j in range(len(values)):
+            with record_timer:
+                scores[j] = self.handle_values(values[j])
+        return scores
+
+    def get_training(self):
+        """
+        @return (numpy.ndarray)  Training vectors of every stream, oldest first.
+        """
+        if isinstance(self.training, list):
+            training = np.array(self.training, dtype=float).reshape(-1, self.num_streams,
+                                                                    self.dim)
+            return training.transpose(1, 0, 2)
+        return np.roll(self.training, -self.training_head, axis=1)
+
+    def freeze_training(self):
+        self.training = np.ascontiguousarray(self.get_training())
+        self.training_head = 0
+        if self.calibration is None:
+            self.calibration = self.new_calibration()
+        self.set_sigma(self.sigma)
+
+    def set_sigma(self, sigma):
+        """
+        Sets the sigma of every stream and whitens the training vectors with it.
+        """
+        self.sigma = sigma
+        try:
+            self.whitening = np.linalg.cholesky((sigma + sigma.transpose(0, 2, 1)) / 2)
+        except np.linalg.LinAlgError:
+            self.whitening = np.array([get_whitening(stream_sigma) for stream_sigma in sigma])
+        self.whitened = np.matmul(self.training, self.whitening)
+
+    def new_calibration(self):
+        return RingBuffer(int(self.probationary_period) + 1, (self.num_streams, self.dim))
+
+    def compute_sigma(self):
+        grams = np.array([np.dot(training.T, training) for training in self.get_training()])
+        try:
+            return np.linalg.inv(grams)
+        except np.linalg.LinAlgError:
+            return np.array([invert_gram(gram) for gram in grams])
+
+    def calibrate(self):
+        """
+        Computes the initial scores, the NCMs of the training vectors of every
+        stream.
+        """
+        num_training = self.training.shape[1]
+        self_rows = (np.arange(num_training) + self.training_head) % num_training
+        self.scores = np.array([
+            bulk_ncm(self.training[s], self.sigma[s], self.training[s][self_rows],
+                     self.k, self_rows)
+            for s in range(self.num_streams)])
+        self.scores_head = 0
+
+    def ncm(self, items):
+        """
+        @param items (numpy.ndarray)  One item per stream.
+
+        @return      (numpy.ndarray)  NCM of the item of every stream.
+        """
+        diff = self.whitened - np.einsum("sd,sde->se", items, self.whitening)[:, None, :]
+        arr = np.einsum("snd,snd->sn", diff, diff)
+        return np.partition(arr, self.k, axis=1)[:, :self.k].sum(axis=1)
+
+    def handle_values(self, values):
+        """
+        Scores one record of every stream, see KnncadDetector.handle_value().
+
+        @param values (numpy.ndarray)  Value of every stream.
+
+        @return       (numpy.ndarray)  Anomaly score of every stream.
+        """
+        self.buf.append(values)
+        self.record_count += 1
+
+        if len(self.buf) < self.dim:
+            return np.zeros(self.num_streams)
+
+        new_items = self.buf.get_window().T
+        if self.record_count < self.probationary_period:
+            self.training.append(new_items.copy())
+            return np.zeros(self.num_streams)
+
+        if isinstance(self.training, list):
+            self.freeze_training()
+
+        ost = self.record_count % self.probationary_period
+        if ost == 0 or ost == int(self.probationary_period / 2):
+            self.set_sigma(self.compute_sigma())
+        if self.scores is None:
+            with self.timer("calibration"):
+                self.calibrate()
+
+        with self.timer("ncm"):
+            new_scores = self.ncm(new_items)
+        result = 1. * (self.scores < new_scores[:, None]).sum(axis=1) / self.scores.shape[1]
+
+        if self.record_count >= 2 * self.probationary_period:
+            self.training[:, self.training_head] = self.calibration.popleft()
+            self.whitened[:, self.training_head] = np.einsum(
+                "sd,sde->se", self.training[:, self.training_head], self.whitening)
+            self.training_head = (self.training_head + 1) % self.training.shape[1]
+
+        # Replace the oldest score
+        self.scores[:, self.scores_head] = new_scores
+        self.scores_head = (self.scores_head + 1) % self.scores.shape[1]
+        self.calibration.append(new_items)
+
+        waiting = self.pred > 0
+        self.pred[waiting] -= 1
+        result[waiting] = 0.5
+        self.pred[~waiting & (result >= 0.9965)] = int(self.probationary_period / 5)
+        return result
+
+    def get_state(self):
+        state = super(MultiStreamKnncadDetector, self).get_state()
+        state["buf"] = self.buf.to_array()
+        state["training"] = self.get_training()
+        state["calibration"] = (self.calibration.to_array() if self.calibration is not None
+                                else np.empty((0, self.num_streams, self.dim)))
+        if self.scores is not None:
+            state["scores"] = np.roll(self.scores, -self.scores_head, axis=1)
+        state["sigma"] = self.sigma
+        state["pred"] = self.pred
+        state["counters"] = np.array([self.record_count, self.k, self.dim])
+        return state
+
+    def set_state(self, state):
+        super(MultiStreamKnncadDetector, self).set_state(state)
+        self.record_count, self.k, self.dim = state["counters"].tolist()
+        self.buf = RingBuffer(self.dim, self.num_streams)
+        self.buf.extend(state["buf"])
+        # Frozen again on the next scored record
+        self.training = list(state["training"].transpose(1, 0, 2))
+        self.training_head = 0
+        self.calibration = None
+        if len(state["calibration"]):
+            self.calibration = self.new_calibration()
+            self.calibration.extend(state["calibration"])
+        self.scores = state["scores"].copy() if "scores" in state else None
+        self.scores_head = 0
+        self.sigma = state["sigma"]
+        self.pred = state["pred"].copy()
@@ -23,30 +23,235 @@ This contains the objects to store and manipulate a database of csv files.
 """
 
 import copy
+import hashlib
 import os
 import json
+import tempfile
+import numpy
 import pandas
 import itertools
 
-from util import absolute_file_paths, create_path, deepmap, strp
+from util import absolute_file_paths, create_path, make_dirs_exist, strp
+
+
+# Default directory of the parsed datafile cache of a Corpus
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nab_corpus")
+
+
+def toEpochNs(timestamps):
+    """
+    @param timestamps  (iterable)       Timestamps, e.g. a timestamp column.
+
+    @return            (numpy.ndarray)  int64 nanoseconds since the epoch.
+    """
+    return numpy.asarray(pandas.to_datetime(timestamps)).astype(
+        "datetime64[ns]").astype(numpy.int64)
+
+
+def labelTimestamps(timestamps, windows):
+    """
+    @param timestamps  (iterable)       Timestamps, e.g. of a chunk of a datafile.
+
+    @param windows     (list)           [start, end] timestamp pairs of the
+                                        anomaly windows of the datafile.
+
+    @return            (numpy.ndarray)  int8 label of every timestamp, 1 within
+                                        a window and 0 elsewhere.
+    """
+    epochs = toEpochNs(timestamps)
+    label = numpy.zeros(len(epochs), dtype=numpy.int8)
+    for t1, t2 in windows:
+        t1, t2 = toEpochNs([t1, t2])
+        label[(epochs >= t1) & (epochs <= t2)] = 1
+    return label
 
 
 class DataFile(object):
     """
     Class for storing and manipulating a single datafile.
-    Data is stored in pandas.DataFrame
+    Data is stored in pandas.DataFrame, parsed on first access of self.data.
     """
 
-    def __init__(self, srcPath):
+    def __init__(self, srcPath, chunkSize=None, cacheDir=None):
         """
-        @param srcPath (string)   Filename of datafile to read.
+        @param srcPath   (string)   Filename of datafile to read.
+
+        @param chunkSize (int)      If given, the datafile is not loaded into
+                                    memory. It is streamed in chunks of this
+                                    many records instead, see iterChunks().
+
+        @param cacheDir  (string)   If given, the parsed data is cached in this
+                                    directory, keyed by the path, modification
+                                    time and size of the datafile, so that it is
+                                    only parsed again once the file changes. The
+                                    cache files of previous versions are removed
+                                    then.
         """
         self.srcPath = srcPath
 
         self.fileName = os.path.split(srcPath)[1]
 
-        self.data = pandas.read_csv(self.srcPath,
-                                    header=0, parse_dates=[0])
+        self.chunkSize = chunkSize
+
+        self.cacheDir = cacheDir
+
+        self._data = None
+        self._numRecords = None
+        self._valueRange = None
+
+        # Epoch index of the timestamp column, see getEpochIndex()
+        self._epochIndex = None
+        self._isSorted = None
+
+    @property
+    def data(self):
+        """
+        pandas.DataFrame of the datafile, or None in streaming mode.
+        """
+        if self._data is None and not self.chunkSize:
+            self._data = self._readData()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._epochIndex = None
+
+    def _readData(self):
+        """Parse the datafile, or load it from the cache if it is up to date.
+        """
+        if self.cacheDir is None:
+            return pandas.read_csv(self.srcPath, header=0, parse_dates=[0])
+
+        cachePath = self._getCachePath()
+        try:
+            with numpy.load(cachePath, allow_pickle=False) as cached:
+                columns = cached["columns"].tolist()
+                return pandas.DataFrame(dict((c, cached["column_%s" % i])
+                                             for i, c in enumerate(columns)),
+                                        columns=columns)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+        data = pandas.read_csv(self.srcPath, header=0, parse_dates=[0])
+        self._writeCache(cachePath, data)
+        return data
+
+    def _getCachePath(self):
+        """
+        @return (string)  Cache file of the current version of the datafile.
+        """
+        stat = os.stat(self.srcPath)
+        key = "%r|%d" % (stat.st_mtime, stat.st_size)
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cacheDir,
+                            "%s%s.npz" % (self._getCachePrefix(), digest))
+
+    def _getCachePrefix(self):
+        """
+        @return (string)  File name prefix shared by all the cache files of the
+                          datafile, whichever version of it they hold.
+        """
+        srcPath = os.path.abspath(self.srcPath)
+        pathDigest = hashlib.sha1(srcPath.encode("utf-8")).hexdigest()[:16]
+        return "%s_%s_" % (self.fileName, pathDigest)
+
+    def _pruneCache(self, cachePath):
+        """Remove the cache files of previous versions of the datafile.
+
+        @param cachePath (string)   Cache file of the current version, kept.
+        """
+        prefix = self._getCachePrefix()
+        for name in os.listdir(self.cacheDir):
+            path = os.path.join(self.cacheDir, name)
+            if (name.startswith(prefix) and name.endswith(".npz")
+                    and path != cachePath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Already pruned by another worker
+                    pass
+
+    def _writeCache(self, cachePath, data):
+        """Store the parsed columns in an .npz file. Datafiles with non-numeric
+        columns are not cached.
+        """
+        arrays = {"columns": numpy.array(list(data.columns), dtype=str)}
+        for i, column in enumerate(data.columns):
+            array = data[column].values
+            if array.dtype.kind not in "biufM":
+                return
+            arrays["column_%s" % i] = array
+
+        make_dirs_exist(self.cacheDir)
+        # Write to a temporary file first, the workers of a run may be caching
+        # the same datafile at the same time
+        fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as cacheFile:
+                numpy.savez(cacheFile, **arrays)
+            os.rename(tmpPath, cachePath)
+        except OSError:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+        self._pruneCache(cachePath)
+
+    def iterChunks(self, chunkSize=None):
+        """Iterate over the records of the datafile in fixed-size chunks. In
+        streaming mode only one chunk is held in memory at a time.
+
+        @param chunkSize (int)    Number of records per chunk. Defaults to the
+                                  chunkSize of the datafile.
+
+        @return          (iterable) pandas.DataFrame chunks in file order.
+        """
+        chunkSize = chunkSize or self.chunkSize
+        if self._data is not None or not self.chunkSize:
+            chunkSize = chunkSize or max(len(self.data), 1)
+            for start in range(0, len(self.data), chunkSize):
+                yield self.data.iloc[start:start + chunkSize]
+        else:
+            for chunk in pandas.read_csv(self.srcPath, header=0, parse_dates=[0],
+                                         chunksize=chunkSize):
+                yield chunk
+
+    def getNumRecords(self):
+        """
+        @return (int)   Number of records in the datafile.
+        """
+        if self._data is not None or not self.chunkSize:
+            return self.data.shape[0]
+        if self._numRecords is None:
+            self._scanValues()
+        return self._numRecords
+
+    def getValueRange(self):
+        """
+        @return (tuple)   Minimum and maximum of the value column.
+        """
+        if self._data is not None or not self.chunkSize:
+            return self.data["value"].min(), self.data["value"].max()
+        if self._valueRange is None:
+            self._scanValues()
+        return self._valueRange
+
+    def _scanValues(self):
+        """Count the records and find the value range of a streamed datafile
+        with a single chunked pass over the value column.
+        """
+        numRecords = 0
+        minValue = maxValue = None
+        for chunk in pandas.read_csv(self.srcPath, header=0, usecols=["value"],
+                                     chunksize=self.chunkSize):
+            if len(chunk) == 0:
+                continue
+            numRecords += len(chunk)
+            chunkMin, chunkMax = chunk["value"].min(), chunk["value"].max()
+            minValue = chunkMin if minValue is None else min(minValue, chunkMin)
+            maxValue = chunkMax if maxValue is None else max(maxValue, chunkMax)
+        self._numRecords = numRecords
+        self._valueRange = (minValue, maxValue)
 
     def write(self, newPath=None):
         """Write datafile to self.srcPath or newPath if given.
@@ -77,6 +282,8 @@ class DataFile(object):
         else:
             if columnName in self.data:
                 del self.data[columnName]
+        if columnName == "timestamp":
+            self._epochIndex = None
 
         if write:
             self.write()
@@ -91,9 +298,88 @@ class DataFile(object):
         @return     (list)  Timestamp and value for each time stamp within the
                             timestamp range.
         """
-        tmp = self.data[self.data["timestamp"] >= t1]
-        ans = tmp[tmp["timestamp"] <= t2]["timestamp"].tolist()
-        return ans
+        return self.data["timestamp"].iloc[self.getRangeIndexer(t1, t2)].tolist()
+
+    def getEpochIndex(self):
+        """
+        @return (numpy.ndarray)  int64 nanoseconds since the epoch of every
+                                 record, computed once per data.
+        """
+        if self._epochIndex is None:
+            self._epochIndex = toEpochNs(self.data["timestamp"])
+            self._isSorted = bool((numpy.diff(self._epochIndex) >= 0).all())
+        return self._epochIndex
+
+    def getRangeIndexer(self, t1, t2):
+        """Find the records within a timestamp range with a binary search.
+
+        @param t1   (timestamp)   Starting timestamp, included.
+
+        @param t2   (timestamp)   Ending timestamp, included.
+
+        @return     (slice)       Positions of the records in the range. For an
+                                  unsorted datafile a boolean mask is returned
+                                  instead. Either way it can index the columns'
+                                  arrays, a slice giving views of them.
+        """
+        epochIndex = self.getEpochIndex()
+        t1, t2 = toEpochNs([t1, t2])
+        if not self._isSorted:
+            return (epochIndex >= t1) & (epochIndex <= t2)
+        return slice(epochIndex.searchsorted(t1, side="left"),
+                     epochIndex.searchsorted(t2, side="right"))
+
+    def getValuesInRange(self, t1, t2, columnName="value"):
+        """
+        @return (numpy.ndarray)  Values of a column within a timestamp range,
+                                 a view of the column for a sorted datafile.
+        """
+        return self.data[columnName].values[self.getRangeIndexer(t1, t2)]
+
+    def getRecordIndex(self, timestamp):
+        """
+        @return (int)  Position of the record of the timestamp.
+
+        @raise  KeyError if no record has this timestamp.
+        """
+        indexer = self.getRangeIndexer(timestamp, timestamp)
+        if isinstance(indexer, slice):
+            if indexer.stop > indexer.start:
+                return int(indexer.start)
+        else:
+            positions = numpy.flatnonzero(indexer)
+            if len(positions):
+                return int(positions[0])
+        raise KeyError("No record at %s in %s" % (timestamp, self.srcPath))
+
+    def countTimestamps(self, timestamps):
+        """
+        @param timestamps (iterable)       Timestamps to look up.
+
+        @return           (numpy.ndarray)  Number of records of each timestamp.
+                                           In streaming mode the timestamp
+                                           column is counted chunk by chunk.
+        """
+        timestamps = toEpochNs(timestamps)
+        if self._data is None and self.chunkSize:
+            epochIndices = (numpy.sort(toEpochNs(chunk["timestamp"]))
+                            for chunk in pandas.read_csv(self.srcPath, header=0,
+                                                         usecols=["timestamp"],
+                                                         chunksize=self.chunkSize))
+        else:
+            epochIndex = self.getEpochIndex()
+            epochIndices = [epochIndex if self._isSorted else numpy.sort(epochIndex)]
+
+        counts = numpy.zeros(len(timestamps), dtype=numpy.int64)
+        for epochIndex in epochIndices:
+            counts += (epochIndex.searchsorted(timestamps, side="right")
+                       - epochIndex.searchsorted(timestamps, side="left"))
+        return counts
+
+    def release(self):
+        """Drop the parsed data, it is parsed again on next access.
+        """
+        self.data = None
 
     def __str__(self):
         ans = ""
@@ -107,14 +393,24 @@ class DataFile(object):
 class Corpus(object):
     """
     Class for storing and manipulating a corpus of data where each datafile is
-    stored as a DataFile object.
+    stored as a DataFile object. The datafiles are only indexed here, each one
+    is parsed on first access of its data.
     """
 
-    def __init__(self, srcRoot):
+    def __init__(self, srcRoot, cacheDir=None, chunkSize=None):
         """
         @param srcRoot    (string)    Source directory of corpus.
+
+        @param chunkSize  (int)       If given, the datafiles are streamed in
+                                      chunks of this many records, see DataFile.
+
+        @param cacheDir   (string)    Directory of the parsed datafile cache, see
+                                      DataFile, e.g. DEFAULT_CACHE_DIR. None, the
+                                      default, disables the cache.
         """
         self.srcRoot = srcRoot
+        self.cacheDir = cacheDir
+        self.chunkSize = chunkSize
         self.dataFiles = self.getDataFiles()
         self.numDataFiles = len(self.dataFiles)
 
@@ -126,7 +422,8 @@ class Corpus(object):
                           the corresponding data files.
         """
         filePaths = absolute_file_paths(self.srcRoot)
-        dataSets = [DataFile(path) for path in filePaths if ".csv" in path]
+        dataSets = [DataFile(path, self.chunkSize, self.cacheDir)
+                    for path in filePaths if ".csv" in path]
 
         def getRelativePath(srcRoot, srcPath):
             return srcPath[srcPath.index(srcRoot) + len(srcRoot):] \
@@ -181,7 +478,7 @@ class Corpus(object):
         else:
             create_path(newRoot)
 
-        newCorpus = Corpus(newRoot)
+        newCorpus = Corpus(newRoot, self.cacheDir, self.chunkSize)
         for relativePath in list(self.dataFiles.keys()):
             newCorpus.addDataSet(relativePath, self.dataFiles[relativePath])
         return newCorpus
@@ -194,6 +491,8 @@ class Corpus(object):
 
         @param datafile          (datafile)     Data set to be added to corpus.
         """
+        # Parse the data from the source path before it is changed
+        dataSet.data
         self.dataFiles[relativePath] = copy.deepcopy(dataSet)
         newPath = self.srcRoot + relativePath
         create_path(newPath)
@@ -226,14 +525,19 @@ class CorpusLabel(object):
     benchmark corpus.
     """
 
-    def __init__(self, path, corpus):
+    def __init__(self, path, corpus, relativePaths=None):
         """
         Initializes a CorpusLabel object by getting the anomaly windows and labels.
         When this is done for combining raw user labels, we skip getLabels()
         because labels are not yet created.
 
-        @param path    (string)      Name of file containing the set of labels.
-        @param corpus  (nab.Corpus)  Corpus object.
+        @param path           (string)      Name of file containing the set of
+                                            labels.
+        @param corpus         (nab.Corpus)  Corpus object.
+        @param relativePaths  (iterable)    If given, only the windows of these
+                                            datafiles are checked and only
+                                            their labels are built, so the
+                                            other datafiles are never parsed.
         """
         self.path = path
 
@@ -241,6 +545,8 @@ class CorpusLabel(object):
         self.labels = None
 
         self.corpus = corpus
+        self.relativePaths = (None if relativePaths is None
+                              else set(relativePaths))
         self.getWindows()
 
         if "raw" not in self.path:
@@ -252,13 +558,6 @@ class CorpusLabel(object):
         Read JSON label file. Get timestamps as dictionaries with key:value pairs of
         a relative path and its corresponding list of windows.
         """
-
-        def found(t, data):
-            f = data["timestamp"][data["timestamp"] == pandas.Timestamp(t)]
-            exists = (len(f) == 1)
-
-            return exists
-
         with open(os.path.join(self.path)) as windowFile:
             windows = json.load(windowFile)
 
@@ -266,25 +565,58 @@ class CorpusLabel(object):
 
         for relativePath in list(windows.keys()):
 
-            self.windows[relativePath] = deepmap(strp, windows[relativePath])
+            self.windows[relativePath] = self.parseWindows(windows[relativePath])
 
-            if len(self.windows[relativePath]) == 0:
+            if len(self.windows[relativePath]) == 0 or not self.isSelected(relativePath):
                 continue
 
-            data = self.corpus.dataFiles[relativePath].data
+            dataSet = self.corpus.dataFiles[relativePath]
             if "raw" in self.path:
-                timestamps = windows[relativePath]
+                timestamps = self.windows[relativePath]
             else:
-                timestamps = list(itertools.chain.from_iterable(windows[relativePath]))
+                timestamps = list(itertools.chain.from_iterable(self.windows[relativePath]))
 
-            # Check that timestamps are present in dataset
-            if not all([found(t, data) for t in timestamps]):
+            # Check that timestamps are present in dataset, exactly once
+            if not (dataSet.countTimestamps(timestamps) == 1).all():
                 raise ValueError("In the label file %s, one of the timestamps used for "
                                  "the datafile %s doesn't match; it does not exist in "
                                  "the file. Timestamps in json label files have to "
                                  "exactly match timestamps in corresponding datafiles."
                                  % (self.path, relativePath))
 
+    def isSelected(self, relativePath):
+        """
+        @return (bool)  Whether the windows and labels of the datafile are used.
+        """
+        return self.relativePaths is None or relativePath in self.relativePaths
+
+    def parseWindows(self, windows):
+        """
+        Parse the timestamps of the windows of a datafile, or of its raw label
+        timestamps, all at once.
+
+        @param windows  (list)  [start, end] pairs of timestamp strings, or
+                                timestamp strings for raw labels.
+
+        @return         (list)  The same structure of pandas.Timestamp.
+        """
+        if "raw" in self.path:
+            timestamps = windows
+        else:
+            timestamps = list(itertools.chain.from_iterable(windows))
+        if len(timestamps) == 0:
+            return []
+
+        try:
+            parsed = list(pandas.to_datetime(timestamps))
+        except ValueError:
+            # Timestamps in mixed formats
+            parsed = [pandas.Timestamp(strp(t)) for t in timestamps]
+
+        if "raw" in self.path:
+            return parsed
+        return [parsed[i:i + 2] for i in range(0, len(parsed), 2)]
+
     def validateLabels(self):
         """
         This is run at the end of the label combining process (see
@@ -298,7 +630,7 @@ class CorpusLabel(object):
 
         for relativePath in list(windows.keys()):
 
-            self.windows[relativePath] = deepmap(strp, windows[relativePath])
+            self.windows[relativePath] = self.parseWindows(windows[relativePath])
 
             if len(self.windows[relativePath]) == 0:
                 continue
@@ -314,24 +646,28 @@ class CorpusLabel(object):
         """
         Get Labels as a dictionary of key-value pairs of a relative path and its
         corresponding binary vector of anomaly labels. Labels are simply a more
-        verbose version of the windows.
+        verbose version of the windows. Streamed datafiles are not labelled
+        here, their chunks are labelled from the windows, see labelTimestamps().
         """
         self.labels = {}
 
         for relativePath, dataSet in self.corpus.dataFiles.items():
+            if not self.isSelected(relativePath):
+                continue
             if relativePath in self.windows:
+                if dataSet.chunkSize:
+                    continue
                 windows = self.windows[relativePath]
 
-                labels = pandas.DataFrame({"timestamp": dataSet.data["timestamp"]})
-                labels['label'] = 0
+                timestamps = dataSet.data["timestamp"]
+                label = numpy.zeros(len(timestamps), dtype=numpy.int8)
 
                 for t1, t2 in windows:
-                    moreThanT1 = labels[labels["timestamp"] >= t1]
-                    betweenT1AndT2 = moreThanT1[moreThanT1["timestamp"] <= t2]
-                    indices = betweenT1AndT2.loc[:, "label"].index
-                    labels["label"].values[indices.values] = 1
+                    label[dataSet.getRangeIndexer(t1, t2)] = 1
 
-                self.labels[relativePath] = labels
+                self.labels[relativePath] = pandas.DataFrame(
+                    {"timestamp": timestamps, "label": label},
+                    columns=["timestamp", "label"])
 
             else:
                 print("Warning: no label for datafile", relativePath)
@@ -19,10 +19,14 @@
 # ----------------------------------------------------------------------
 
 import math
+import pickle
+import tempfile
+import numpy
 from nupic.algorithms import anomaly_likelihood
 from nupic.frameworks.opf.common_models.cluster_params import getScalarMetricWithTimeOfDayAnomalyParams
 from nupic.frameworks.opf.model_factory import ModelFactory
 from AnomalyDetector import AnomalyDetector
+from rolling import RollingMax, RollingMin
 
 # Fraction outside of the range of values seen so far that will be considered
 # a spatial anomaly regardless of the anomaly likelihood calculation. This
@@ -30,6 +34,11 @@ from AnomalyDetector import AnomalyDetector
 # has been seen so far.
 SPATIAL_TOLERANCE = 0.05
 
+# Number of buckets of the RDSE value encoder. Values further than half of them
+# times the encoder resolution from the first encoded value all fall into the
+# edge bucket.
+RDSE_MAX_BUCKETS = 1000
+
 
 class NumentaDetector(AnomalyDetector):
     """
@@ -42,8 +51,11 @@ class NumentaDetector(AnomalyDetector):
         self.sensor_params = None
         self.anomaly_likelihood = None
         # Keep track of value range for spatial anomaly detection
-        self.min_val = None
-        self.max_val = None
+        self.min_tracker = RollingMin()
+        self.max_tracker = RollingMax()
+
+        # First value seen by the current model, the RDSE is centered on it
+        self.encoder_offset = None
 
         # Set this to False if you want to get results based on raw scores
         # without using AnomalyLikelihood. This will give worse results, but
@@ -64,27 +76,32 @@ class NumentaDetector(AnomalyDetector):
         Internally to NuPIC "anomaly_score" corresponds to "likelihood_score"
         and "raw_score" corresponds to "anomaly_score". Sorry about that.
         """
-        # Send it to Numenta detector and get back the results
-        result = self.model.run(input_data)
-
         # Get the value
         value = input_data["value"]
 
+        if self.encoder_offset is None:
+            self.encoder_offset = value
+        elif abs(value - self.encoder_offset) > self._get_encoder_reach():
+            self._rebase_value_range(value)
+
+        # Send it to Numenta detector and get back the results
+        result = self.model.run(input_data)
+
         # Retrieve the anomaly score and write it to a file
         raw_score = result.inferences["anomalyScore"]
 
         # Update min/max values and check if there is a spatial anomaly
         spatial_anomaly = False
-        if self.min_val != self.max_val:
-            tolerance = (self.max_val - self.min_val) * SPATIAL_TOLERANCE
-            max_expected = self.max_val + tolerance
-            min_expected = self.min_val - tolerance
+        min_val = self.min_tracker.value
+        max_val = self.max_tracker.value
+        if min_val != max_val:
+            tolerance = (max_val - min_val) * SPATIAL_TOLERANCE
+            max_expected = max_val + tolerance
+            min_expected = min_val - tolerance
             if value > max_expected or value < min_expected:
                 spatial_anomaly = True
-        if self.max_val is None or value > self.max_val:
-            self.max_val = value
-        if self.min_val is None or value < self.min_val:
-            self.min_val = value
+        self.max_tracker.append(value)
+        self.min_tracker.append(value)
 
         if self.use_likelihood:
             # Compute log(anomaly likelihood)
@@ -100,6 +117,55 @@ class NumentaDetector(AnomalyDetector):
 
         return final_score, raw_score
 
+    def get_state(self):
+        """
+        Adds the capnp serialization of the model and the pickled anomaly
+        likelihood, both as byte arrays.
+        """
+        state = super(NumentaDetector, self).get_state()
+        if self.model is None:
+            return state
+
+        # pycapnp needs a real file to write to
+        with tempfile.TemporaryFile() as model_file:
+            self.model.writeToFile(model_file)
+            model_file.seek(0)
+            state["model"] = numpy.frombuffer(model_file.read(), dtype=numpy.uint8)
+
+        if self.anomaly_likelihood is not None:
+            state["anomaly_likelihood"] = numpy.frombuffer(
+                pickle.dumps(self.anomaly_likelihood, 2), dtype=numpy.uint8)
+
+        if self.min_tracker.value is not None:
+            state["min_val"] = numpy.asarray(self.min_tracker.value)
+            state["max_val"] = numpy.asarray(self.max_tracker.value)
+        if self.encoder_offset is not None:
+            state["encoder_offset"] = numpy.asarray(self.encoder_offset)
+        return state
+
+    def set_state(self, state):
+        super(NumentaDetector, self).set_state(state)
+        if "model" not in state:
+            return
+
+        # Sets up the encoder parameters, the model is then replaced
+        self.initialize()
+        with tempfile.TemporaryFile() as model_file:
+            model_file.write(state["model"].tobytes())
+            model_file.seek(0)
+            self.model = type(self.model).readFromFile(model_file)
+
+        if "anomaly_likelihood" in state:
+            self.anomaly_likelihood = pickle.loads(state["anomaly_likelihood"].tobytes())
+
+        self.min_tracker = RollingMin()
+        self.max_tracker = RollingMax()
+        if "min_val" in state:
+            self.min_tracker.append(state["min_val"].item())
+            self.max_tracker.append(state["max_val"].item())
+        if "encoder_offset" in state:
+            self.encoder_offset = state["encoder_offset"].item()
+
     def initialize(self):
         # Get config params, setting the RDSE resolution
         range_padding = abs(self.input_max - self.input_min) * 0.2
@@ -127,6 +193,35 @@ class NumentaDetector(AnomalyDetector):
                 reestimationPeriod=100
             )
 
+    def _get_encoder_reach(self):
+        """
+        Returns how far from the encoder offset a value can be before the RDSE
+        clips it into its edge bucket.
+        """
+        return self.sensorParams["resolution"] * RDSE_MAX_BUCKETS / 2
+
+    def _rebase_value_range(self, value):
+        """
+        Rebuilds the model with an RDSE resolution covering a value that would
+        otherwise be clipped. This can only happen in streaming mode, where the
+        range is estimated during a warm-up.
+
+        A rebase resets the learning of the detector: the model and the anomaly
+        likelihood relearn from scratch. A new resolution changes the encoding
+        of every value, so the spatial pooler connections and the sequences
+        learned on the old encoding would not match anything anymore and only
+        the encoder cannot be swapped. The likelihood goes through its learning
+        period again instead of reporting the relearning as anomalies. The RDSE
+        reaches about four times the padded warm-up range, so rebases are rare,
+        and a longer warm-up makes them rarer still.
+        """
+        self.input_min = min(self.input_min, value)
+        self.input_max = max(self.input_max, value)
+        print("Rebasing the value range to [%s, %s], the model relearns from scratch"
+              % (self.input_min, self.input_max))
+        self.initialize()
+        self.encoder_offset = value
+
     def _setup_encoder_params(self, encoder_params):
         # The encoder must expect the NAB-specific datafile headers
         encoder_params["timestamp_dayOfWeek"] = encoder_params.pop("c0_dayOfWeek")
@@ -0,0 +1,333 @@
+"""
+Throughput and latency benchmark of the detectors on synthetic series.
+
+Every (detector, series) pair runs in a fresh process so that the peak RSS
+belongs to that run alone. The results are written as JSON, and a previous
+results file can be given with --compare to spot regressions between
+versions, e.g.
+
+    python benchmark.py --lengths 1000 10000 --output bench_new.json \\
+        --compare bench_old.json
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from timeit import default_timer
+
+import numpy
+import pandas
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS is not reported there
+    resource = None
+
+from AnomalyDetector import AnomalyDetector
+from instrumentation import Instrumentation
+from NABCorpus import DataFile
+
+
+# Detector names mapped to (module, class). They are imported in the benchmark
+# process, so a detector with missing dependencies is reported as skipped.
+DETECTORS = {
+    "ContextOSEDetector": ("CADOSEDetector", "ContextOSEDetector"),
+    "KnncadDetector": ("KnnCadDetector", "KnncadDetector"),
+    "NumentaDetectorTM": ("NumentaDetectorTM", "NumentaDetectorTM"),
+    "EarthgeckoSkylineDetector": ("skyline.EarthGeckoSkylineDetector",
+                                  "EarthgeckoSkylineDetector"),
+    "HSTreeDetector": ("HSTreeDetector", "HSTreeDetector"),
+}
+
+SERIES_KINDS = ("sin", "noise", "spikes", "steps")
+
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def generate_series(kind, length, seed=42, interval=60):
+    """
+    Generates a synthetic series.
+
+    @param kind      (string)  One of SERIES_KINDS:
+                               "sin"    the sin.csv signal, 100 radians over
+                                        3500 records,
+                               "noise"  gaussian noise,
+                               "spikes" the sin signal with noise and a spike
+                                        every 500 records on average,
+                               "steps"  a noisy signal whose level shifts every
+                                        1000 records.
+
+    @param length    (int)     Number of records.
+
+    @param seed      (int)     Seed of the random parts.
+
+    @param interval  (int)     Seconds between two records.
+
+    @return          (pandas.DataFrame)  timestamp and value columns.
+    """
+    rng = numpy.random.RandomState(seed)
+    t = numpy.arange(length) * (100.0 / 3500)
+
+    if kind == "sin":
+        values = numpy.sin(t)
+    elif kind == "noise":
+        values = rng.normal(size=length)
+    elif kind == "spikes":
+        values = numpy.sin(t) + rng.normal(scale=0.1, size=length)
+        spikes = rng.rand(length) < 1.0 / 500
+        values[spikes] += rng.choice([-3.0, 3.0], size=spikes.sum())
+    elif kind == "steps":
+        levels = rng.normal(scale=5.0, size=length // 1000 + 1)
+        values = levels[numpy.arange(length) // 1000] + rng.normal(size=length)
+    else:
+        raise ValueError("Unknown series kind %s, expected one of %s"
+                         % (kind, ", ".join(SERIES_KINDS)))
+
+    timestamps = (pandas.Timestamp("2021-01-01")
+                  + pandas.to_timedelta(numpy.arange(length) * interval, unit="s"))
+    return pandas.DataFrame({"timestamp": timestamps, "value": values},
+                            columns=["timestamp", "value"])
+
+
+def get_peak_rss():
+    """
+    @return (int)  Peak resident set size of this process in bytes, or None.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def load_detector_class(detector_name):
+    """
+    @return  The AnomalyDetector subclass of the name.
+
+    @raise   ImportError when the detector cannot be used in this environment.
+    """
+    module_name, class_name = DETECTORS[detector_name]
+    detector_class = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(detector_class, type)
+            and issubclass(detector_class, AnomalyDetector)):
+        raise ImportError("%s is not an AnomalyDetector yet" % detector_name)
+    return detector_class
+
+
+def benchmark_detector(args):
+    """
+    Scores a series in batches through process_batch(), the path of run(),
+    and measures the detector. The per-record latencies are the "handle_record"
+    histogram of the detector's instrumentation. Runs in its own process.
+
+    @return (dict)  The measurements of the run.
+    """
+    detector_name, data_path, probationary_percent, batch_size = args
+
+    result = {"detector": detector_name}
+    try:
+        detector_class = load_detector_class(detector_name)
+    except Exception as e:
+        result["skipped"] = "%s: %s" % (type(e).__name__, e)
+        return result
+
+    rss_before = get_peak_rss()
+
+    start = default_timer()
+    detector = detector_class(data_set=DataFile(data_path),
+                              probationary_percent=probationary_percent)
+    detector.initialize()
+    result["init_seconds"] = default_timer() - start
+
+    instrumentation = Instrumentation()
+    detector.enable_instrumentation(instrumentation)
+    timestamps, values = detector.get_input_arrays()
+    process_batch = detector.process_batch
+
+    start = default_timer()
+    for batch_start in range(0, len(values), batch_size):
+        batch_stop = batch_start + batch_size
+        process_batch(timestamps[batch_start:batch_stop], values[batch_start:batch_stop])
+    total = default_timer() - start
+
+    result["records"] = len(values)
+    result["batch_size"] = batch_size
+    result["total_seconds"] = total
+    result["records_per_second"] = len(values) / total if total else None
+    summary = instrumentation.get_histogram("handle_record").get_summary(
+        LATENCY_PERCENTILES)
+    result["latency_seconds"] = dict((name, summary[name]) for name in summary
+                                     if name != "count")
+
+    rss_after = get_peak_rss()
+    result["peak_rss_bytes"] = rss_after
+    if rss_before is not None:
+        result["peak_rss_increase_bytes"] = rss_after - rss_before
+    return result
+
+
+def get_version():
+    """
+    @return (string)  git description of the working tree, or None.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(detector_names, kinds, lengths, probationary_percent=0.15,
+                   seed=42, batch_size=1000):
+    """
+    Benchmarks every detector on every (kind, length) series.
+
+    @param batch_size  (int)  Records per process_batch() call, as in run().
+
+    @return (dict)  The report, with one entry per run under "results".
+    """
+    work_dir = tempfile.mkdtemp(prefix="detector_benchmark_")
+    results = []
+    try:
+        for kind in kinds:
+            for length in lengths:
+                data_path = os.path.join(work_dir, "%s_%s.csv" % (kind, length))
+                generate_series(kind, length, seed).to_csv(data_path, index=False)
+
+                for detector_name in detector_names:
+                    # A fresh process per run keeps the peak RSS of the runs apart
+                    pool = multiprocessing.Pool(1)
+                    try:
+                        result = pool.apply(benchmark_detector,
+                                            ((detector_name, data_path,
+                                              probationary_percent, batch_size),))
+                    finally:
+                        pool.close()
+                        pool.join()
+
+                    result.update({"series": kind, "length": length})
+                    print_result(result)
+                    results.append(result)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {
+        "version": get_version(),
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "platform": platform.platform(),
+        "probationary_percent": probationary_percent,
+        "seed": seed,
+        "batch_size": batch_size,
+        "results": results,
+    }
+
+
+def print_result(result):
+    name = "%s on %s/%s" % (result["detector"], result["series"], result["length"])
+    if "skipped" in result:
+        print("%-50s skipped (%s)" % (name, result["skipped"]))
+        return
+    latency = result["latency_seconds"]
+    print("%-50s %10.1f rec/s  p50 %8.1fus  p99 %8.1fus  max %9.1fus  peak RSS %s MB"
+          % (name, result["records_per_second"], latency["p50"] * 1e6,
+             latency["p99"] * 1e6, latency["max"] * 1e6,
+             "-" if result["peak_rss_bytes"] is None
+             else "%.1f" % (result["peak_rss_bytes"] / 2.0 ** 20)))
+
+
+def compare_reports(old_report, new_report):
+    """
+    Prints the throughput and p99 latency change of the runs present in both
+    reports.
+    """
+    def key(result):
+        return result["detector"], result["series"], result["length"]
+
+    def change(new_value, old_value):
+        # A zero or missing measurement, e.g. a p99 below the timer
+        # resolution, has no relative change
+        if not new_value or not old_value:
+            return "    n/a"
+        return "%+7.1f%%" % (100.0 * (new_value / old_value - 1))
+
+    old_results = {key(r): r for r in old_report["results"] if "skipped" not in r}
+    print("Compared with %s (%s)" % (old_report.get("version"), old_report.get("date")))
+    for new in new_report["results"]:
+        old = old_results.get(key(new))
+        if old is None or "skipped" in new:
+            continue
+        print("%-50s throughput %s  p99 latency %s"
+              % ("%s on %s/%s" % key(new),
+                 change(new["records_per_second"], old["records_per_second"]),
+                 change(new["latency_seconds"]["p99"], old["latency_seconds"]["p99"])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--detectors",
+                        nargs="*",
+                        type=str,
+                        default=sorted(DETECTORS),
+                        help="Space separated list of detector names to run")
+
+    parser.add_argument("--kinds",
+                        nargs="*",
+                        type=str,
+                        default=["sin"],
+                        help="Synthetic series to run on, among %s"
+                             % ", ".join(SERIES_KINDS))
+
+    parser.add_argument("--lengths",
+                        nargs="*",
+                        type=int,
+                        default=[5000],
+                        help="Lengths of the synthetic series")
+
+    parser.add_argument("--probationaryPercent",
+                        default=0.15,
+                        type=float)
+
+    parser.add_argument("--seed",
+                        default=42,
+                        type=int)
+
+    parser.add_argument("--batchSize",
+                        default=1000,
+                        type=int,
+                        help="Records per process_batch() call, as in main.py runs")
+
+    parser.add_argument("--output",
+                        default="benchmark_%s.json" % time.strftime("%Y%m%d_%H%M%S"),
+                        help="JSON file the report is written to")
+
+    parser.add_argument("--compare",
+                        default=None,
+                        help="Previous JSON report to compare the results with")
+
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.detectors, args.kinds, args.lengths,
+                            args.probationaryPercent, args.seed, args.batchSize)
+
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print("Report written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as old_file:
+            compare_reports(json.load(old_file), report)
@@ -0,0 +1,262 @@
+"""
+Optional latency instrumentation of the detectors' hot paths.
+
+An Instrumentation object holds one HDR-style LatencyHistogram per named
+timer. AnomalyDetector.run() records every handle_batch() call and every
+record scored within it into it once AnomalyDetector.enable_instrumentation()
+is called, and detectors time their own stages with
+AnomalyDetector.timer(name). Without
+instrumentation timer() returns NULL_TIMER, which does nothing.
+"""
+
+import json
+from timeit import default_timer
+
+from util import create_path
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style histogram of latencies. Values are kept as integer nanoseconds
+    in log-linear buckets: every power of two range is split in sub-buckets, so
+    the relative error of any recorded value is bounded by the number of
+    significant figures, with a memory that only grows with the log of the
+    largest value.
+    """
+
+    def __init__(self, significant_figures=2):
+        """
+        @param significant_figures (int)  Decimal precision kept for every value.
+        """
+        self.significant_figures = significant_figures
+        # Smallest power of two holding 2 * 10**significant_figures values
+        self.sub_bucket_bits = (2 * 10 ** significant_figures - 1).bit_length()
+        self.sub_bucket_half = 1 << (self.sub_bucket_bits - 1)
+
+        self.counts = [0] * (2 * self.sub_bucket_half)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def get_index(self, value):
+        """
+        @param value (int)  Value in nanoseconds.
+
+        @return      (int)  Index of the bucket holding the value.
+        """
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        return shift * self.sub_bucket_half + (value >> shift)
+
+    def get_value(self, index):
+        """
+        @return (int)  Highest value in nanoseconds held by the bucket.
+        """
+        if index < 2 * self.sub_bucket_half:
+            return index
+        shift = index // self.sub_bucket_half - 1
+        sub_bucket = index - shift * self.sub_bucket_half
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        """
+        Records one latency given in seconds.
+        """
+        value = int(seconds * 1e9)
+        index = self.get_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Adds the values of another histogram of the same precision.
+        """
+        if other.significant_figures != self.significant_figures:
+            raise ValueError("Cannot merge histograms of different precision")
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def get_percentile(self, percentile):
+        """
+        @param percentile (float)  Percentile between 0 and 100.
+
+        @return           (float)  Latency in seconds below which the given
+                                   percent of the values are, or None if empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(percentile / 100.0 * self.count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.get_value(index), self.max) / 1e9
+        return self.max / 1e9
+
+    def get_summary(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        @return (dict)  Count, mean, min, max and percentiles in seconds.
+        """
+        summary = {
+            "count": self.count,
+            "mean": self.total / 1e9 / self.count if self.count else None,
+            "min": self.min / 1e9 if self.min is not None else None,
+            "max": self.max / 1e9,
+        }
+        for percentile in percentiles:
+            summary["p%s" % percentile] = self.get_percentile(percentile)
+        return summary
+
+    def to_dict(self):
+        """
+        @return (dict)  Summary along with the non-empty buckets, as
+                        [highest value in seconds, count] pairs.
+        """
+        summary = self.get_summary()
+        summary["significant_figures"] = self.significant_figures
+        summary["buckets"] = [[self.get_value(index) / 1e9, count]
+                              for index, count in enumerate(self.counts) if count]
+        return summary
+
+
+class Timer(object):
+    """
+    Context manager recording the time spent in its block into a histogram.
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.record(default_timer() - self.start)
+        return False
+
+
+class NullTimer(object):
+    """
+    Timer used when instrumentation is disabled.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def null_timer(name):
+    """
+    Timer factory used when instrumentation is disabled.
+    """
+    return NULL_TIMER
+
+
+class Instrumentation(object):
+    """
+    Named latency histograms of a detector run, sampled periodically.
+    """
+
+    def __init__(self, sample_interval=None, on_sample=None,
+                 significant_figures=2):
+        """
+        @param sample_interval     (float)     Seconds between two samples of
+                                               the histograms during a run, or
+                                               None to only export at the end.
+
+        @param on_sample           (function)  Called with every sample, e.g.
+                                               to log it.
+
+        @param significant_figures (int)       Precision of the histograms.
+        """
+        self.sample_interval = sample_interval
+        self.on_sample = on_sample
+        self.significant_figures = significant_figures
+
+        self.histograms = {}
+        self.timers = {}
+        self.samples = []
+        self.start = default_timer()
+        self.last_sample = self.start
+
+    def get_histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = LatencyHistogram(self.significant_figures)
+            self.histograms[name] = histogram
+        return histogram
+
+    def timer(self, name):
+        """
+        @return (Timer)  Context manager timing its block into the histogram of
+                         the name. Timers are reused, so they must not be
+                         nested under the same name.
+        """
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = Timer(self.get_histogram(name))
+            self.timers[name] = timer
+        return timer
+
+    def record(self, name, seconds):
+        self.get_histogram(name).record(seconds)
+
+    def maybe_sample(self):
+        """
+        Takes a sample of the histogram summaries if sample_interval has passed
+        since the previous one. Cheap enough to be called once per batch.
+        """
+        if self.sample_interval is None:
+            return
+        now = default_timer()
+        if now - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = now
+
+        sample = {"elapsed": now - self.start,
+                  "histograms": {name: histogram.get_summary()
+                                 for name, histogram in self.histograms.items()}}
+        self.samples.append(sample)
+        if self.on_sample is not None:
+            self.on_sample(sample)
+
+    def to_dict(self):
+        return {
+            "elapsed": default_timer() - self.start,
+            "histograms": {name: histogram.to_dict()
+                           for name, histogram in self.histograms.items()},
+            "samples": self.samples,
+        }
+
+    def export(self, path):
+        """
+        Writes the histograms and samples to a JSON file.
+        """
+        create_path(path)
+        with open(path, "w") as export_file:
+            json.dump(self.to_dict(), export_file, indent=2)
@@ -1,77 +1,114 @@
+import argparse
+
 from NumentaDetectorTM import NumentaDetectorTM
 from CADOSEDetector import ContextOSEDetector
 from KnnCadDetector import KnncadDetector
 from skyline.EarthGeckoSkylineDetector import EarthgeckoSkylineDetector
-from AnomalyDetector import detect_data_set
-from NABCorpus import Corpus, CorpusLabel
-import time
-
+from NABCorpus import DEFAULT_CACHE_DIR
+from runner import Runner
+from sinks import SINKS
 
-done = 0
 
-def run_on_file(filename, detectorConstructor, detectorName):
-    global done, results_dir, corpus, corpus_label
-    done += 1
-    args = (i, detectorConstructor(data_set=corpus.dataFiles[filename], probationary_percent=0.15),
-            detectorName, corpus_label.labels[filename]["label"], results_dir, filename)
-    detect_data_set(args)
+DETECTORS = {
+    "ContextOSEDetector": ContextOSEDetector,
+    "KnncadDetector": KnncadDetector,
+    "NumentaDetectorTM": NumentaDetectorTM,
+    "EarthgeckoSkylineDetector": EarthgeckoSkylineDetector,
+}
 
 
 if __name__ == "__main__":
-    results_dir = "C:\\EreBere\\timeseries\\offi"
-
-    #data_dir = "C:\\EreBere\\timeseries\\data\\YahooWithTime"
-    #data_dir = "C:\\EreBere\\timeseries\\AnomalyDetection\\data\\streams"
-    data_dir = "C:\\EreBere\\timeseries\\idosorok"
-    label_path = "C:\\EreBere\\timeseries\\AnomalyDetection\\data\\labels\\combined_windows.json"
-
-    corpus = Corpus(data_dir)
-    corpus_label = CorpusLabel(label_path, corpus)
-    i = 0
-    run_on_file("sin.csv", NumentaDetectorTM, "NumentaDetectorTM")
-    # times_cadose = []
-    # times_knn = []
-    # times_htm = []
-    # times_skyline = []
-    # for i in range(1, 10):
-    #     t1 = time.time()
-    #     run_on_file("real_" + str(i) + ".csv", ContextOSEDetector, "ContextOSEDetector")
-    #     t2 = time.time()
-    #     run_on_file("real_" + str(i) + ".csv", KnncadDetector, "KnncadDetector")
-    #     t3 = time.time()
-    #     run_on_file("real_" + str(i) + ".csv", NumentaDetectorTM, "NumentaDetectorTM")
-    #     t4 = time.time()
-    #     run_on_file("real_" + str(i) + ".csv", EarthgeckoSkylineDetector, "EarthgeckoSkylineDetector")
-    #     t5 = time.time()
-    #     times_cadose.append(t2 - t1)
-    #     times_knn.append(t3 - t2)
-    #     times_htm.append(t4 - t3)
-    #     times_skyline.append(t5 - t4)
-    #     print(t2 - t1, t3 - t2, t4 - t3, t5 - t4)
-    # # run_on_file("Twitter_volume_AMZN.csv")
-    # print("cadose", sum(times_cadose) / len(times_cadose))
-    # print("knn", sum(times_knn) / len(times_knn))
-    # print("htm", sum(times_htm) / len(times_htm))
-    # print("skyline", sum(times_skyline) / len(times_skyline))
-
-    t1 = time.time()
-    run_on_file("A.csv", ContextOSEDetector, "ContextOSEDetector")
-    # run_on_file("B.csv", ContextOSEDetector, "ContextOSEDetector")
-    # run_on_file("C.csv", ContextOSEDetector, "ContextOSEDetector")
-    #
-    t2 = time.time()
-    run_on_file("A.csv", KnncadDetector, "KnncadDetector")
-    # run_on_file("B.csv", KnncadDetector, "KnncadDetector")
-    # run_on_file("C.csv", KnncadDetector, "KnncadDetector")
-    #
-    t3 = time.time()
-    run_on_file("A.csv", NumentaDetectorTM, "NumentaDetectorTM")
-    # run_on_file("B.csv", NumentaDetectorTM, "NumentaDetectorTM")
-    # run_on_file("C.csv", NumentaDetectorTM, "NumentaDetectorTM")
-    #
-    t4 = time.time()
-    run_on_file("A.csv", EarthgeckoSkylineDetector, "EarthgeckoSkylineDetector")
-    # run_on_file("B.csv", EarthgeckoSkylineDetector, "EarthgeckoSkylineDetector")
-    # run_on_file("C.csv", EarthgeckoSkylineDetector, "EarthgeckoSkylineDetector")
-    t5 = time.time()
-    print(t2 - t1, t3 - t2, t4 - t3, t5 - t4)
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--resultsDir",
+                        default="C:\\EreBere\\timeseries\\offi",
+                        help="Directory the results are written to")
+
+    #"C:\\EreBere\\timeseries\\data\\YahooWithTime"
+    #"C:\\EreBere\\timeseries\\AnomalyDetection\\data\\streams"
+    parser.add_argument("--dataDir",
+                        default="C:\\EreBere\\timeseries\\idosorok",
+                        help="Source directory of the corpus")
+
+    parser.add_argument("--labelPath",
+                        default="C:\\EreBere\\timeseries\\AnomalyDetection\\data\\labels\\combined_windows.json",
+                        help="JSON file of the combined label windows")
+
+    parser.add_argument("-d", "--detectors",
+                        nargs="*",
+                        type=str,
+                        default=sorted(DETECTORS),
+                        help="Space separated list of detector names to run")
+
+    parser.add_argument("--query",
+                        default="",
+                        help="Only run on the files whose relative path contains "
+                             "this string, e.g. A.csv")
+
+    parser.add_argument("-n", "--numCPUs",
+                        default=None,
+                        type=int,
+                        help="Number of worker processes, defaults to the number "
+                             "of cores")
+
+    parser.add_argument("--chunkSize",
+                        default=None,
+                        type=int,
+                        help="Stream the datafiles in chunks of this many records "
+                             "instead of loading them whole")
+
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        help="Do not read the datafiles ahead of scoring, estimate "
+                             "the value range during a warm-up instead")
+
+    parser.add_argument("--probationaryPeriod",
+                        default=None,
+                        type=int,
+                        help="Probationary period in records instead of 15%% of the "
+                             "file length")
+
+    parser.add_argument("--outputFormat",
+                        default="csv",
+                        choices=sorted(SINKS),
+                        help="Format of the result files, npy and parquet are "
+                             "binary columnar formats")
+
+    parser.add_argument("--cacheDir",
+                        nargs="?",
+                        default=None,
+                        const=DEFAULT_CACHE_DIR,
+                        help="Cache the parsed datafiles in this directory, %s if "
+                             "no directory is given. Without this flag the "
+                             "datafiles are parsed on every run" % DEFAULT_CACHE_DIR)
+
+    parser.add_argument("--instrument",
+                        action="store_true",
+                        help="Record latency histograms of the detectors, written "
+                             "next to each result file")
+
+    parser.add_argument("--sampleInterval",
+                        default=None,
+                        type=float,
+                        help="Seconds between two printed latency samples of an "
+                             "instrumented run")
+
+    args = parser.parse_args()
+
+    detector_kwargs = {"streaming": args.streaming}
+    if args.probationaryPeriod is not None:
+        detector_kwargs["probationary_period"] = args.probationaryPeriod
+
+    runner = Runner(data_dir=args.dataDir,
+                    label_path=args.labelPath,
+                    results_dir=args.resultsDir,
+                    num_cpus=args.numCPUs,
+                    chunk_size=args.chunkSize,
+                    detector_kwargs=detector_kwargs,
+                    instrument=args.instrument,
+                    sample_interval=args.sampleInterval,
+                    output_format=args.outputFormat,
+                    cache_dir=args.cacheDir)
+    runner.initialize(query=args.query)
+    runner.detect({name: DETECTORS[name] for name in args.detectors},
+                  query=args.query)
@@ -0,0 +1,363 @@
+"""
+Rolling structures of the streaming detectors, so that their memory stays
+bounded over unbounded streams and that every record costs O(1) amortized
+instead of a rescan of the history.
+"""
+
+import bisect
+from collections import deque
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Fixed-capacity FIFO of scalars or vectors. Every item is stored twice, at
+    its position and capacity rows further, so that any window of consecutive
+    items is a contiguous view of the storage instead of a copy.
+    """
+
+    def __init__(self, capacity, dim=None, dtype=float):
+        """
+        @param capacity  (int)    Maximum number of items. Appending to a full
+                                  buffer drops its oldest item.
+
+        @param dim       (int)    Length of the vector items, None for scalars.
+                                  A tuple gives the shape of array items.
+        """
+        self.capacity = int(capacity)
+        self.dim = dim
+        if dim is None:
+            shape = (2 * self.capacity,)
+        elif isinstance(dim, tuple):
+            shape = (2 * self.capacity,) + dim
+        else:
+            shape = (2 * self.capacity, dim)
+        self.storage = np.zeros(shape, dtype=dtype)
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, item):
+        if self.size == self.capacity:
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+        position = (self.head + self.size) % self.capacity
+        self.storage[position] = item
+        self.storage[position + self.capacity] = item
+        self.size += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def popleft(self):
+        """
+        @return  Copy of the oldest item, removed from the buffer.
+        """
+        if not self.size:
+            raise IndexError("pop from an empty RingBuffer")
+        item = self.storage[self.head].copy()
+        self.head = (self.head + 1) % self.capacity
+        self.size -= 1
+        return item
+
+    def get_window(self, length=None):
+        """
+        @param length  (int)            Number of items, all of them by default.
+
+        @return        (numpy.ndarray)  View of the most recent items, oldest
+                                        first. It is overwritten as items are
+                                        appended, copy it to keep it.
+        """
+        length = self.size if length is None else min(length, self.size)
+        start = (self.head + self.size - length) % self.capacity
+        return self.storage[start:start + length]
+
+    def to_array(self):
+        """
+        @return (numpy.ndarray)  Copy of all the items, oldest first.
+        """
+        return self.get_window().copy()
+
+
+class SortedBlocks(object):
+    """
+    Sorted multiset of floats with rank queries, stored as a list of sorted
+    blocks of at most 2 * load values. A Fenwick tree over the block lengths
+    gives the number of values before a block, so that inserting, removing
+    and ranking a value cost O(log n + load) instead of the O(n) shift of a
+    single sorted list. The Fenwick tree is rebuilt only when a block is
+    split or emptied.
+    """
+
+    def __init__(self, values=(), load=256):
+        """
+        @param values  (iterable)  Initial values, in any order. They must not
+                                   be NaN, which has no place in the order.
+
+        @param load    (int)       Target length of the blocks.
+        """
+        self.load = load
+        values = sorted(values)
+        self.blocks = [values[i:i + load] for i in range(0, len(values), load)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(values)
+        self.rebuild_tree()
+
+    def __len__(self):
+        return self.size
+
+    def rebuild_tree(self):
+        tree = [0] + [len(block) for block in self.blocks]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def update_tree(self, block_index, delta):
+        i = block_index + 1
+        tree = self.tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def count_before(self, block_index):
+        """
+        @return (int)  Number of values in the blocks before the block.
+        """
+        count = 0
+        i = block_index
+        tree = self.tree
+        while i > 0:
+            count += tree[i]
+            i -= i & -i
+        return count
+
+    def add(self, value):
+        if not self.blocks:
+            self.blocks.append([value])
+            self.maxes.append(value)
+            self.size = 1
+            self.rebuild_tree()
+            return
+        i = bisect.bisect_left(self.maxes, value)
+        if i == len(self.blocks):
+            i -= 1
+        block = self.blocks[i]
+        bisect.insort(block, value)
+        self.maxes[i] = block[-1]
+        self.size += 1
+        if len(block) > 2 * self.load:
+            self.blocks[i + 1:i + 1] = [block[self.load:]]
+            del block[self.load:]
+            self.maxes[i:i + 1] = [block[-1], self.blocks[i + 1][-1]]
+            self.rebuild_tree()
+        else:
+            self.update_tree(i, 1)
+
+    def remove(self, value):
+        i = bisect.bisect_left(self.maxes, value)
+        if i == len(self.blocks):
+            raise ValueError("%r is not in the SortedBlocks" % (value,))
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, value)
+        if block[j] != value:
+            raise ValueError("%r is not in the SortedBlocks" % (value,))
+        del block[j]
+        self.size -= 1
+        if block:
+            self.maxes[i] = block[-1]
+            self.update_tree(i, -1)
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+            self.rebuild_tree()
+
+    def rank(self, value):
+        """
+        @return (int)  Number of values strictly smaller than the value.
+        """
+        i = bisect.bisect_left(self.maxes, value)
+        if i == len(self.blocks):
+            return self.size
+        return self.count_before(i) + bisect.bisect_left(self.blocks[i], value)
+
+
+class RankedWindow(object):
+    """
+    FIFO window of scores that also keeps them sorted, so that the rank of a
+    new score among them is a binary search.
+
+    NaN scores are ranked as +inf, which like NaN is never strictly smaller
+    than a score, and a NaN score is ranked above no score.
+    """
+
+    def __init__(self, values=()):
+        self.values = deque(values)
+        self.sorted_values = SortedBlocks(self.sort_key(value) for value in self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    @staticmethod
+    def sort_key(value):
+        return float("inf") if value != value else value
+
+    def append(self, value):
+        self.values.append(value)
+        self.sorted_values.add(self.sort_key(value))
+
+    def popleft(self):
+        value = self.values.popleft()
+        self.sorted_values.remove(self.sort_key(value))
+        return value
+
+    def rank(self, value):
+        """
+        @return (int)  Number of scores strictly smaller than the value.
+        """
+        if value != value:
+            return 0
+        return self.sorted_values.rank(value)
+
+    def to_list(self):
+        """
+        @return (list)  The scores, oldest first.
+        """
+        return list(self.values)
+
+
+class RollingMax(object):
+    """
+    Maximum of the last values appended. A monotonic deque holds the values
+    which can still become the maximum, each with its index, so that every
+    value is pushed and popped at most once.
+    """
+
+    def __init__(self, window=None):
+        """
+        @param window  (int)  Number of most recent values covered, None for
+                              all of them.
+        """
+        self.window = window
+        self.candidates = deque()
+        self.count = 0
+
+    def __len__(self):
+        return self.count if self.window is None else min(self.count, self.window)
+
+    @staticmethod
+    def dominates(value, other):
+        """
+        @return (bool)  Whether other can no longer be the extremum once value
+                        is appended after it.
+        """
+        return value >= other
+
+    def append(self, value):
+        candidates = self.candidates
+        while candidates and self.dominates(value, candidates[-1][1]):
+            candidates.pop()
+        # Without a window a value that is not the extremum never becomes it
+        if self.window is None and candidates:
+            self.count += 1
+            return
+        candidates.append((self.count, value))
+        self.count += 1
+        if self.window is not None and candidates[0][0] <= self.count - 1 - self.window:
+            candidates.popleft()
+
+    @property
+    def value(self):
+        """
+        @return  The extremum of the window, None when it is empty.
+        """
+        return self.candidates[0][1] if self.candidates else None
+
+
+class RollingMin(RollingMax):
+    """
+    Minimum of the last values appended, see RollingMax.
+    """
+
+    @staticmethod
+    def dominates(value, other):
+        return value <= other
+
+
+class ScoreHistory(object):
+    """
+    Fixed-capacity history of scores with their rolling maximum.
+    """
+
+    def __init__(self, capacity=None, scores=()):
+        """
+        @param capacity  (int)   Number of most recent scores kept, None for all
+                                 of them.
+
+        @param scores    (list)  Initial scores, oldest first.
+        """
+        self.scores = deque(maxlen=capacity)
+        self.maximum = RollingMax(capacity)
+        for score in scores:
+            self.append(score)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def append(self, score):
+        self.scores.append(score)
+        self.maximum.append(score)
+
+    def max(self):
+        """
+        @return (float)  Largest score of the history.
+        """
+        if not self.scores:
+            raise ValueError("max of an empty ScoreHistory")
+        return self.maximum.value
+
+    def to_list(self):
+        """
+        @return (list)  The scores, oldest first.
+        """
+        return list(self.scores)
+
+
+class ExpiryWindow(object):
+    """
+    Tells whether a flagged item was appended within a duration of a time.
+
+    This is a scan of the items from the newest one back, stopping at the first
+    item older than the duration. An item older than the duration, even out of
+    order, hides the flagged items before it. Such a scan finds a flagged item
+    if and only if the oldest timestamp since the last flagged item, which is
+    all the window keeps, is within the duration.
+    """
+
+    def __init__(self, duration):
+        """
+        @param duration  (int)  Length of the window, in the unit of the
+                                timestamps.
+        """
+        self.duration = duration
+        # Oldest timestamp appended since the last flagged item, None before
+        # any flagged item
+        self.horizon = None
+
+    def append(self, timestamp, flagged=False):
+        if flagged:
+            self.horizon = timestamp
+        elif self.horizon is not None:
+            self.horizon = min(self.horizon, timestamp)
+
+    def active(self, timestamp):
+        """
+        @return (bool)  Whether an item within the duration before the
+                        timestamp, up to the newest one, is flagged.
+        """
+        return self.horizon is not None and self.horizon > timestamp - self.duration
@@ -0,0 +1,194 @@
+"""
+Schedules every (datafile x detector) pair of a corpus over a pool of worker
+processes.
+"""
+
+import multiprocessing
+
+from AnomalyDetector import detect_data_set
+from instrumentation import Instrumentation
+from NABCorpus import Corpus, CorpusLabel, DataFile
+
+
+def build_and_detect_data_set(args):
+    """
+    Function called in each worker process. The datafile is read and the
+    detector is built inside the worker, so neither has to be pickled, then
+    the detection is done by detect_data_set.
+    """
+    (i, detector_class, detector_name, probationary_percent, detector_kwargs,
+     src_path, chunk_size, labels, output_dir, relative_path,
+     instrument, sample_interval, output_format, cache_dir) = args
+
+    detector_instance = detector_class(data_set=DataFile(src_path, chunk_size,
+                                                         cache_dir),
+                                       probationary_percent=probationary_percent,
+                                       **detector_kwargs)
+    if instrument:
+        detector_instance.enable_instrumentation(
+            Instrumentation(sample_interval=sample_interval,
+                            on_sample=lambda sample: print_sample(i, sample)))
+
+    detect_data_set((i, detector_instance, detector_name, labels, output_dir,
+                     relative_path, output_format))
+
+
+def print_sample(i, sample):
+    """
+    Prints the p50/p99 latencies of a sample taken during an instrumented run.
+    """
+    print("%s: %.0fs elapsed, %s" % (
+        i, sample["elapsed"],
+        ", ".join("%s p50 %.1fus p99 %.1fus" % (name, summary["p50"] * 1e6,
+                                                summary["p99"] * 1e6)
+                  for name, summary in sorted(sample["histograms"].items()))))
+
+
+class Runner(object):
+    """
+    Runs a set of detectors on all the datafiles of a corpus.
+    """
+
+    def __init__(self, data_dir, label_path, results_dir, num_cpus=None,
+                 probationary_percent=0.15, chunk_size=None,
+                 detector_kwargs=None, instrument=False, sample_interval=None,
+                 output_format="csv", cache_dir=None):
+        """
+        @param data_dir             (string)  Source directory of the corpus.
+
+        @param label_path           (string)  Path of the combined label windows.
+
+        @param results_dir          (string)  Directory the results are written to.
+
+        @param num_cpus             (int)     Number of worker processes. Defaults
+                                              to the number of cores.
+
+        @param probationary_percent (float)   Probationary percent passed to every
+                                              detector.
+
+        @param chunk_size           (int)     If given, the workers stream each
+                                              datafile in chunks of this many
+                                              records and append the results to
+                                              the output file chunk by chunk.
+                                              The datafiles are then never
+                                              loaded whole, the labels of each
+                                              chunk are computed from the
+                                              windows.
+
+        @param detector_kwargs      (dict)    Extra keyword arguments of every
+                                              detector, e.g. streaming=True.
+
+        @param instrument           (bool)    Record latency histograms of the
+                                              detectors, written next to each
+                                              result file as *_latency.json.
+
+        @param sample_interval      (float)   Seconds between two printed
+                                              samples of the histograms of an
+                                              instrumented run.
+
+        @param output_format        (string)  Format of the result files, one of
+                                              sinks.SINKS.
+
+        @param cache_dir            (string)  Directory of the parsed datafile
+                                              cache, e.g.
+                                              NABCorpus.DEFAULT_CACHE_DIR. None,
+                                              the default, always parses the
+                                              CSV files.
+        """
+        self.data_dir = data_dir
+        self.label_path = label_path
+        self.results_dir = results_dir
+        self.num_cpus = num_cpus or multiprocessing.cpu_count()
+        self.probationary_percent = probationary_percent
+        self.chunk_size = chunk_size
+        self.detector_kwargs = detector_kwargs or {}
+        self.instrument = instrument
+        self.sample_interval = sample_interval
+        self.output_format = output_format
+        self.cache_dir = cache_dir
+
+        self.corpus = None
+        self.corpus_label = None
+
+    def initialize(self, query=""):
+        """
+        Load the corpus and the labels of the datafiles to process.
+
+        @param query  (string)  Only the datafiles whose relative path contains
+                                the query are parsed and labelled, pass the
+                                query given to detect().
+        """
+        self.corpus = Corpus(self.data_dir, self.cache_dir, self.chunk_size)
+        self.corpus_label = CorpusLabel(self.label_path, self.corpus,
+                                        self.corpus.getDataSubset(query))
+        # The workers read the datafiles again, the parent only keeps the labels
+        for data_file in self.corpus.dataFiles.values():
+            data_file.release()
+
+    def get_jobs(self, detectors, query=""):
+        """
+        Builds the argument tuples of build_and_detect_data_set for every
+        (datafile x detector) pair, longest datafile first. Dispatching the
+        longest jobs first keeps a long file from starting last and leaving the
+        other workers idle at the end of the run.
+
+        @param detectors  (dict)    Detector names mapped to detector classes.
+
+        @param query      (string)  Only the datafiles whose relative path
+                                    contains the query are scheduled.
+
+        @return           (list)    Argument tuples in scheduling order.
+        """
+        data_files = self.corpus.getDataSubset(query)
+
+        def file_length(relative_path):
+            if self.chunk_size:
+                # Counted with a streamed pass over the value column
+                return data_files[relative_path].getNumRecords()
+            # The labels have one row per record
+            return len(self.corpus_label.labels[relative_path].index)
+
+        jobs = []
+        for relative_path in sorted(data_files, key=file_length, reverse=True):
+            if self.chunk_size:
+                # The workers label each chunk from the windows
+                labels = self.corpus_label.windows.get(relative_path, [])
+            else:
+                labels = self.corpus_label.labels[relative_path]["label"].values
+            for detector_name in sorted(detectors):
+                jobs.append((len(jobs), detectors[detector_name], detector_name,
+                             self.probationary_percent, self.detector_kwargs,
+                             data_files[relative_path].srcPath,
+                             self.chunk_size, labels,
+                             self.results_dir, relative_path,
+                             self.instrument, self.sample_interval,
+                             self.output_format, self.cache_dir))
+        return jobs
+
+    def detect(self, detectors, query=""):
+        """
+        Runs all the detectors on the corpus.
+
+        @param detectors  (dict)    Detector names mapped to detector classes.
+                                    Classes are pickled by reference, so they
+                                    have to be importable by the workers.
+
+        @param query      (string)  Only the datafiles whose relative path
+                                    contains the query are processed.
+        """
+        jobs = self.get_jobs(detectors, query)
+        print("Running %s jobs on %s cores" % (len(jobs), self.num_cpus))
+
+        if self.num_cpus == 1:
+            for args in jobs:
+                build_and_detect_data_set(args)
+            return
+
+        pool = multiprocessing.Pool(self.num_cpus)
+        try:
+            # chunksize=1 hands the jobs out one by one in the order above
+            for _ in pool.imap_unordered(build_and_detect_data_set, jobs, 1):
+                pass
+        finally:
+            pool.close()
+            pool.join()
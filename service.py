@@ -0,0 +1,309 @@
+"""
+Long-lived scoring service. It keeps one streaming detector per (stream id,
+detector name) and scores the records it receives over a local TCP or Unix
+socket.
+
+The protocol is newline delimited JSON. Every request line is a record
+
+    {"stream": "host1.cpu", "detector": "KnncadDetector",
+     "timestamp": "2021-01-01 00:00:00", "value": 0.5}
+
+and is answered with one line holding the same stream, detector and timestamp
+along with the detector's scores, e.g. "anomaly_score", or with an "error".
+Responses of different streams may come back out of order, the records of a
+single stream are always scored in order.
+
+Detectors listed as heavy are not scored on the event loop. They live in
+worker processes sharded by stream id, so a slow KNN-CAD stream only delays
+the streams of its own shard and never the cheap detectors scored inline.
+
+asyncio requires Python 3, so detectors depending on nupic cannot be served.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import pandas
+
+
+# Detector names mapped to (module, class) of the detectors that run on
+# Python 3, imported by load_detectors()
+SERVED_DETECTORS = {
+    "ContextOSEDetector": ("CADOSEDetector", "ContextOSEDetector"),
+    "KnncadDetector": ("KnnCadDetector", "KnncadDetector"),
+    "EarthgeckoSkylineDetector": ("skyline.EarthGeckoSkylineDetector",
+                                  "EarthgeckoSkylineDetector"),
+}
+
+# Detectors dispatched to the worker processes by default
+HEAVY_DETECTORS = ("KnncadDetector",)
+
+# Registry of the worker process, see _init_worker
+_worker_registry = None
+
+
+class DetectorRegistry(object):
+    """
+    Live detector instances, one per (stream id, detector name), built on the
+    first record of the pair.
+    """
+
+    def __init__(self, detectors, detector_kwargs=None):
+        """
+        @param detectors       (dict)  Detector names mapped to AnomalyDetector
+                                       subclasses.
+
+        @param detector_kwargs (dict)  Extra keyword arguments of the detectors,
+                                       e.g. probationary_period.
+        """
+        self.detectors = detectors
+        self.detector_kwargs = detector_kwargs or {}
+        self.instances = {}
+
+    def get(self, stream_id, detector_name):
+        """
+        Returns the detector of the pair, building it if needed.
+        """
+        key = (stream_id, detector_name)
+        detector = self.instances.get(key)
+        if detector is None:
+            if detector_name not in self.detectors:
+                raise KeyError("Unknown detector %s" % detector_name)
+            kwargs = dict(probationary_percent=0.15, streaming=True)
+            kwargs.update(self.detector_kwargs)
+            detector = self.detectors[detector_name](data_set=None, **kwargs)
+            self.instances[key] = detector
+        return detector
+
+    def score(self, stream_id, detector_name, timestamp, value):
+        """
+        Scores one record of a stream.
+
+        @return (dict)  Output column names mapped to the scores of the record.
+        """
+        detector = self.get(stream_id, detector_name)
+        scores = detector.process_batch(
+            numpy.array([pandas.Timestamp(timestamp).to_datetime64()]),
+            numpy.array([value], dtype=float))[0]
+        return dict(zip(detector.get_header()[2:], scores.tolist()))
+
+
+def load_detectors(detector_names=None):
+    """
+    Imports the served detectors, skipping the ones whose dependencies are
+    missing.
+
+    @param detector_names (iterable)  Names of SERVED_DETECTORS, all of them
+                                      by default.
+
+    @return               (dict)      Detector names mapped to AnomalyDetector
+                                      subclasses.
+    """
+    detectors = {}
+    for detector_name in detector_names or sorted(SERVED_DETECTORS):
+        module_name, class_name = SERVED_DETECTORS[detector_name]
+        try:
+            detectors[detector_name] = getattr(importlib.import_module(module_name),
+                                               class_name)
+        except ImportError as e:
+            print("Skipping %s: %s" % (detector_name, e))
+    return detectors
+
+
+def _init_worker(detectors, detector_kwargs):
+    global _worker_registry
+    _worker_registry = DetectorRegistry(detectors, detector_kwargs)
+
+
+def _score_in_worker(stream_id, detector_name, timestamp, value):
+    return _worker_registry.score(stream_id, detector_name, timestamp, value)
+
+
+class ScoringService(object):
+    """
+    Accepts records over a socket and scores them with the detectors of a
+    DetectorRegistry.
+    """
+
+    def __init__(self, detectors, heavy_detectors=HEAVY_DETECTORS,
+                 num_shards=None, detector_kwargs=None):
+        """
+        @param detectors       (dict)      Detector names mapped to
+                                           AnomalyDetector subclasses.
+
+        @param heavy_detectors (iterable)  Names of the detectors scored in the
+                                           worker processes.
+
+        @param num_shards      (int)       Number of worker processes, defaults
+                                           to the number of cores.
+
+        @param detector_kwargs (dict)      Extra keyword arguments of the
+                                           detectors.
+        """
+        self.registry = DetectorRegistry(detectors, detector_kwargs)
+        self.heavy_detectors = set(heavy_detectors)
+
+        # One single-process executor per shard, so the records of a stream are
+        # scored in the order they were submitted. The workers are spawned
+        # rather than forked, a forked worker would inherit the client sockets
+        # open at the time and keep them from closing.
+        num_shards = num_shards or multiprocessing.cpu_count()
+        context = multiprocessing.get_context("spawn")
+        self.shards = [ProcessPoolExecutor(1, mp_context=context,
+                                           initializer=_init_worker,
+                                           initargs=(detectors, detector_kwargs))
+                       for _ in range(num_shards)]
+
+    def get_shard(self, stream_id):
+        """
+        Returns the executor of the stream. crc32 is used instead of hash() so
+        that the sharding does not change between runs.
+        """
+        return self.shards[zlib.crc32(stream_id.encode("utf-8")) % len(self.shards)]
+
+    def submit(self, record):
+        """
+        Starts scoring a record.
+
+        @param record  (dict)  Decoded request line.
+
+        @return        (asyncio.Future)  Resolves to the response dict. Heavy
+                                         detectors are submitted to their shard
+                                         before this returns.
+        """
+        loop = asyncio.get_event_loop()
+        response = {key: record.get(key) for key in ("stream", "detector", "timestamp")}
+        try:
+            args = (str(record["stream"]), record["detector"], record["timestamp"],
+                    record["value"])
+        except KeyError as e:
+            response["error"] = "Missing field %s" % e
+            future = loop.create_future()
+            future.set_result(response)
+            return future
+
+        if args[1] in self.heavy_detectors:
+            scoring = loop.run_in_executor(self.get_shard(args[0]),
+                                           _score_in_worker, *args)
+        else:
+            scoring = loop.create_future()
+            try:
+                scoring.set_result(self.registry.score(*args))
+            except Exception as e:
+                scoring.set_exception(e)
+
+        async def respond():
+            try:
+                response.update(await scoring)
+            except Exception as e:
+                response["error"] = "%s: %s" % (type(e).__name__, e)
+            return response
+
+        return asyncio.ensure_future(respond())
+
+    async def handle_connection(self, reader, writer):
+        """
+        Reads request lines until the client disconnects and writes a response
+        line as soon as each record is scored.
+        """
+        def write_response(task):
+            writer.write((json.dumps(task.result()) + "\n").encode("utf-8"))
+
+        pending = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError as e:
+                writer.write((json.dumps({"error": "Invalid JSON: %s" % e}) + "\n")
+                             .encode("utf-8"))
+                continue
+            if not isinstance(record, dict):
+                writer.write((json.dumps({"error": "Expected a JSON object, got %s"
+                                          % type(record).__name__}) + "\n")
+                             .encode("utf-8"))
+                continue
+
+            task = self.submit(record)
+            task.add_done_callback(write_response)
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            await writer.drain()
+
+        if pending:
+            await asyncio.wait(pending)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8787, unix_path=None):
+        """
+        Serves until cancelled, on a Unix socket if unix_path is given and on a
+        local TCP port otherwise.
+        """
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle_connection,
+                                                     path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving on %s" % (unix_path or "%s:%s" % (host, port)))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        for executor in self.shards:
+            executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", default="127.0.0.1")
+
+    parser.add_argument("--port", default=8787, type=int)
+
+    parser.add_argument("--unixPath",
+                        default=None,
+                        help="Listen on this Unix socket instead of TCP")
+
+    parser.add_argument("-n", "--numShards",
+                        default=None,
+                        type=int,
+                        help="Number of worker processes of the heavy detectors, "
+                             "defaults to the number of cores")
+
+    parser.add_argument("--probationaryPeriod",
+                        default=None,
+                        type=int,
+                        help="Probationary period of the detectors in records")
+
+    parser.add_argument("-d", "--detectors",
+                        nargs="*",
+                        type=str,
+                        default=sorted(SERVED_DETECTORS),
+                        choices=sorted(SERVED_DETECTORS),
+                        help="Space separated list of detector names to serve")
+
+    args = parser.parse_args()
+
+    detector_kwargs = {}
+    if args.probationaryPeriod is not None:
+        detector_kwargs["probationary_period"] = args.probationaryPeriod
+
+    service = ScoringService(load_detectors(args.detectors), num_shards=args.numShards,
+                             detector_kwargs=detector_kwargs)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unixPath))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,233 @@
+"""
+Result sinks, the output formats of detect_data_set.
+
+    "csv"      One CSV file, as always.
+    "npy"      A .npydir directory holding one .npy file per column, which can
+               be loaded memory-mapped. Timestamps are datetime64[ns], values and
+               scores float64 and labels int8.
+    "parquet"  One Parquet file with the same column types. Requires pyarrow.
+
+Every sink is written chunk by chunk, so the chunked runs of detect_data_set
+never hold the whole results in memory. load_columns() and load_results() read
+the results back whatever their format.
+"""
+
+import json
+import os
+import struct
+
+import numpy
+import pandas
+
+from util import create_path, make_dirs_exist
+
+
+# Size of the .npy headers written by NumpySink. The header is rewritten with
+# the final shape once all the chunks are appended, so it has a fixed size.
+NPY_HEADER_SIZE = 128
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+# Name of the file holding the column order of a NumpySink directory
+NPY_COLUMNS_FILE = "columns.json"
+
+
+def get_column_array(results, column):
+    """
+    @return (numpy.ndarray)  Column of a results DataFrame with the dtype it
+                             is stored with.
+    """
+    if column == "timestamp":
+        return numpy.asarray(results[column].values, dtype="datetime64[ns]")
+    if column == "label":
+        return numpy.asarray(results[column].values, dtype=numpy.int8)
+    return numpy.asarray(results[column].values, dtype=numpy.float64)
+
+
+class ResultSink(object):
+    """
+    Writes the results DataFrames of a detector run, possibly in chunks.
+    """
+
+    extension = None
+
+    def __init__(self, path):
+        """
+        @param path  (string)  Output path, its extension is replaced by the
+                               one of the format.
+        """
+        self.path = os.path.splitext(path)[0] + self.extension
+        create_path(self.path)
+        self.num_records = 0
+
+    def write(self, results):
+        """
+        Appends a chunk of results.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class CSVSink(ResultSink):
+
+    extension = ".csv"
+
+    def write(self, results):
+        results.to_csv(self.path, index=False,
+                       mode="a" if self.num_records else "w",
+                       header=not self.num_records)
+        self.num_records += len(results.index)
+
+
+class NumpySink(ResultSink):
+    """
+    Writes every column to its own .npy file of a .npydir directory, appending
+    the data of each chunk after a fixed size header that is completed on
+    close(). The directory is not named .npy, which numpy.load() would take for
+    a single array.
+    """
+
+    extension = ".npydir"
+
+    def __init__(self, path):
+        super(NumpySink, self).__init__(path)
+        make_dirs_exist(self.path)
+        self.columns = None
+        self.dtypes = {}
+        self.files = {}
+
+    def write(self, results):
+        if self.columns is None:
+            self.columns = list(results.columns)
+            for column in self.columns:
+                column_file = open(os.path.join(self.path, column + ".npy"), "wb")
+                column_file.write(b"\0" * NPY_HEADER_SIZE)
+                self.files[column] = column_file
+
+        for column in self.columns:
+            array = get_column_array(results, column)
+            self.dtypes[column] = array.dtype
+            self.files[column].write(array.tobytes())
+        self.num_records += len(results.index)
+
+    def close(self):
+        if self.columns is None:
+            return
+        for column in self.columns:
+            column_file = self.files[column]
+            column_file.seek(0)
+            write_npy_header(column_file, self.dtypes[column], self.num_records)
+            column_file.close()
+        with open(os.path.join(self.path, NPY_COLUMNS_FILE), "w") as columns_file:
+            json.dump(self.columns, columns_file)
+        self.columns = None
+
+
+class ParquetSink(ResultSink):
+
+    extension = ".parquet"
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet output format requires pyarrow, "
+                              "use the npy format otherwise")
+        super(ParquetSink, self).__init__(path)
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def write(self, results):
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(get_column_array(results, column))
+             for column in results.columns],
+            names=list(results.columns))
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.num_records += len(results.index)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+SINKS = {
+    "csv": CSVSink,
+    "npy": NumpySink,
+    "parquet": ParquetSink,
+}
+
+
+def get_sink(path, output_format="csv"):
+    """
+    @param path           (string)  Output path of the results.
+
+    @param output_format  (string)  One of the SINKS.
+
+    @return               (ResultSink)
+    """
+    if output_format not in SINKS:
+        raise ValueError("Unknown output format %s, expected one of %s"
+                         % (output_format, ", ".join(sorted(SINKS))))
+    return SINKS[output_format](path)
+
+
+def write_npy_header(npy_file, dtype, length):
+    """
+    Writes a version 1.0 .npy header of NPY_HEADER_SIZE bytes for a 1-D array.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), length)
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + "\n"
+    npy_file.write(NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+
+def load_columns(path, mmap_mode="r"):
+    """
+    Loads the columns of a results file of any format.
+
+    @param path       (string)  Path of the results, with the extension of
+                                their format.
+
+    @param mmap_mode  (string)  Memory-map mode of the .npy columns, None to
+                                read them in memory.
+
+    @return           (list)    (column name, numpy.ndarray) pairs in the
+                                column order of the results. The .npy columns
+                                are memory-mapped, no data is read until used.
+    """
+    if path.endswith(NumpySink.extension):
+        with open(os.path.join(path, NPY_COLUMNS_FILE)) as columns_file:
+            columns = json.load(columns_file)
+        return [(column, numpy.load(os.path.join(path, column + ".npy"),
+                                    mmap_mode=mmap_mode))
+                for column in columns]
+
+    if path.endswith(ParquetSink.extension):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+        return [(name, table.column(name).to_numpy()) for name in table.column_names]
+
+    results = pandas.read_csv(path, header=0, parse_dates=[0],
+                              float_precision="round_trip")
+    return [(column, get_column_array(results, column)) for column in results.columns]
+
+
+def load_results(path, mmap_mode="r"):
+    """
+    @return (pandas.DataFrame)  Results of any format, see load_columns.
+    """
+    columns = load_columns(path, mmap_mode)
+    return pandas.DataFrame(dict(columns), columns=[name for name, _ in columns])
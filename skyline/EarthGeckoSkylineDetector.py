@@ -1,6 +1,8 @@
 import time
 import sys
+import numpy
 from AnomalyDetector import AnomalyDetector
+from rolling import ExpiryWindow
 import datetime
 epoch = datetime.datetime.utcfromtimestamp(0)
 from skyline.algorithms import (
@@ -10,7 +12,9 @@ from skyline.algorithms import (
     mean_subtraction_cumulation,
     median_absolute_deviation,
     stddev_from_moving_average,
-    least_squares)
+    least_squares,
+    StreamingAlgorithm,
+    STREAMING_ALGORITHMS)
 
 ####
 # USER SETTINGS see README.md
@@ -91,9 +95,8 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
         # Store our running history
         self.timeseries = []
 
-        # Store our running history with the anomalyScore for evaluation in
-        # terms of expiration
-        self.timeseries_and_anomalyscores = []
+        # Whether an anomaly was scored in the last EXPIRATION_TIME seconds
+        self.expiry = ExpiryWindow(EXPIRATION_TIME)
 
         self.recordCount = 0
         # These algorithms are ordered in terms of efficiency to achieve CONSENSUS
@@ -121,6 +124,10 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
                 least_squares,
             ]
 
+        # Fed every datapoint by handle_point()
+        self.streaming_algorithms = []
+        self.reset_streaming_algorithms()
+
         self.LOCAL_DEBUG = LOCAL_DEBUG
         if LOCAL_DEBUG:
             rundate = time.strftime("%Y-%m-%d %H:%M:%S")
@@ -135,13 +142,49 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
             with open(LOCAL_DEBUG_PATH + '/nab.earthgecko_skyline.score.txt', 'w') as scorefile:
                 scorefile.write('# %s\n' % rundate)
 
+    def reset_streaming_algorithms(self):
+        """
+        Replaces the algorithms that have a streaming version by a new one, fed
+        the datapoints of the timeseries so far. The streaming versions cover
+        the whole timeseries, so they are not used with SHORTEN_TIMESERIES.
+        """
+        if SHORTEN_TIMESERIES:
+            return
+        self.algorithms = [
+            STREAMING_ALGORITHMS[algo]() if algo in STREAMING_ALGORITHMS else algo
+            for algo in (getattr(algo, "function", algo) for algo in self.algorithms)]
+        self.streaming_algorithms = [algo for algo in self.algorithms
+                                     if isinstance(algo, StreamingAlgorithm)]
+        for timestamp, value in self.timeseries:
+            for algo in self.streaming_algorithms:
+                algo.update(timestamp, value)
+
+    def get_state(self):
+        state = super(EarthgeckoSkylineDetector, self).get_state()
+        state["timeseries_timestamps"] = numpy.array(
+            [row[0] for row in self.timeseries], dtype=numpy.int64)
+        state["timeseries_values"] = numpy.array([row[1] for row in self.timeseries])
+        # Empty before the first anomaly
+        state["expiry_horizon"] = numpy.array(
+            [] if self.expiry.horizon is None else [self.expiry.horizon],
+            dtype=numpy.int64)
+        return state
+
+    def set_state(self, state):
+        super(EarthgeckoSkylineDetector, self).set_state(state)
+        self.timeseries = [list(row) for row in zip(
+            state["timeseries_timestamps"].tolist(),
+            state["timeseries_values"].tolist())]
+        self.reset_streaming_algorithms()
+        self.expiry = ExpiryWindow(EXPIRATION_TIME)
+        for horizon in state["expiry_horizon"].tolist():
+            self.expiry.horizon = horizon
+
     def handle_record(self, inputData):
         """
         Returns a list [anomalyScore].
         """
 
-        score = 0.0
-
         # Determine the resolution of the time series being analysed as all NAB
         # data sets are not equal, most have a 5 minute resolution but some
         # have more than 5 mins.  Not done in this round of testing, but
@@ -154,10 +197,40 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
         # Convert the Timestamp object to a epoch timestamp
         timestamp = (ts - epoch).total_seconds()
 
-        inputRow = [int(timestamp), inputData["value"]]
+        return self.handle_point(int(timestamp), inputData["value"], inputData)
+
+    def handle_batch(self, timestamps, values):
+        """
+        Returns an array with one [anomalyScore] row per record.
+        """
+        if self.LOCAL_DEBUG:
+            # The debug files are written from the full inputData dictionaries
+            return super(EarthgeckoSkylineDetector, self).handle_batch(timestamps, values)
+
+        # Convert all the timestamps to epoch seconds at once
+        epoch_seconds = timestamps.astype("datetime64[s]").astype(numpy.int64)
+
+        record_timer = self.timer("handle_record")
+        scores = numpy.empty((len(values), 1))
+        for j, value in enumerate(values):
+            with record_timer:
+                scores[j] = self.handle_point(int(epoch_seconds[j]), value)
+        return scores
+
+    def handle_point(self, timestamp, value, inputData=None):
+        """
+        Returns a list [anomalyScore] for a datapoint given as a Skyline unix
+        timestamp and its value.
+        """
+
+        score = 0.0
+
+        inputRow = [timestamp, value]
         self.timeseries.append(inputRow)
+        for algo in self.streaming_algorithms:
+            algo.update(timestamp, value)
         if self.LOCAL_DEBUG:
-            nabinputRow = [inputData["timestamp"], inputData["value"]]
+            nabinputRow = [inputData["timestamp"], value]
             with open(LOCAL_DEBUG_PATH + '/nab.debug.txt', 'a') as debugfile:
                 debugfile.write(str(inputData))
             with open(LOCAL_DEBUG_PATH + '/nab.ts.debug.txt', 'w') as tsdebugfile:
@@ -167,16 +240,7 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
         # account Skyline's expiration concept, which reduces noise.
         # So if an anomaly has been seen in the last EXPIRATION_TIME seconds,
         # do not process and return an anomalyScore of 0.0
-        process_datapoint = True
-        expiration_timestamp = int(timestamp) - EXPIRATION_TIME
-        if self.timeseries_and_anomalyscores:
-            for ts, datapoint, anomalyscore in reversed(self.timeseries_and_anomalyscores):
-                if int(ts) > expiration_timestamp:
-                    if int(anomalyscore) == 1:
-                        process_datapoint = False
-                        break
-                else:
-                    break
+        process_datapoint = not self.expiry.active(int(timestamp))
         if not process_datapoint:
             return [score]
 
@@ -204,7 +268,8 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
                     consensus_possible = True
                 if consensus_possible:
                     number_of_algorithms_run += 1
-                    algorithm_result = algo(analyse_timeseries, self.LOCAL_DEBUG, LOCAL_DEBUG_PATH)
+                    with self.timer(algo.__name__):
+                        algorithm_result = algo(analyse_timeseries, self.LOCAL_DEBUG, LOCAL_DEBUG_PATH)
                     if algorithm_result:
                         triggered_algorithms.append(algo)
                         # score += algorithm_result
@@ -243,8 +308,8 @@ class EarthgeckoSkylineDetector(AnomalyDetector):
         else:
             averageScore = 0.0
 
-        new_inputRow = [int(timestamp), inputData["value"], anomalyScore]
-        self.timeseries_and_anomalyscores.append(new_inputRow)
+        new_inputRow = [timestamp, value, anomalyScore]
+        self.expiry.append(int(timestamp), int(anomalyScore) == 1)
 
         if self.LOCAL_DEBUG:
             if not process_datapoint:
@@ -2,9 +2,30 @@
 All algorithms from the original skyline implementation are included below.
 """
 
+import math
 import numpy as np
 import pandas
 import traceback
+from collections import deque
+
+# Relative distance of a streaming test statistic to its threshold under which
+# the decision is left to the original algorithm, as the running moments are
+# not rounded like the pandas ones
+NEAR_TIE = 1e-12
+
+# Relative distance of the singular value ratio of a least squares fit to the
+# rank cutoff of np.linalg.lstsq under which the fit is left to lstsq
+NEAR_RANK_CUTOFF = 1e-3
+
+
+def lstsq_rcond(num_rows):
+    """
+    Relative cutoff of the singular values passed to np.linalg.lstsq by
+    least_squares(), the default of numpy 2.0 for a [x, 1] design matrix.
+    Passing it explicitly makes the same fit on every numpy version, whose
+    defaults differ.
+    """
+    return np.finfo(float).eps * max(num_rows, 2)
 
 
 def tail_avg(timeseries, debug, debug_path):
@@ -194,7 +215,10 @@ def least_squares(timeseries, debug, debug_path):
         # m, c = np.linalg.lstsq(A, y)[0]
         # BUT HERE IN NAB with numpy==1.11.2 revert back to old format
         # m, c = np.linalg.lstsq(A, y, rcond=-1)[0]
-        m, c = np.linalg.lstsq(A, y)[0]
+        # m, c = np.linalg.lstsq(A, y)[0]
+        # The cutoff of numpy 2.0 on every numpy version, which
+        # StreamingLeastSquares reproduces
+        m, c = np.linalg.lstsq(A, y, rcond=lstsq_rcond(len(x)))[0]
 
         errors = []
         # Evaluate append once, not every time in the loop - this gains ~0.020 s on
@@ -256,3 +280,242 @@ def histogram_bins(timeseries, debug, debug_path):
             with open(debug_path + '/nab.earthgecko_skyline.algorithm.errors.txt', 'a') as errorfile:
                 errorfile.write(errorline)
         return None
+
+
+class RunningMoments(object):
+    """
+    Welford's running count, mean and sum of squared deviations of the values,
+    skipping NaN like pandas.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        if value != value:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def get_mean(self):
+        return self.mean if self.count else float("nan")
+
+    def get_std(self):
+        """
+        Sample standard deviation, as pandas.Series.std().
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else float("nan")
+
+
+class StreamingAlgorithm(object):
+    """
+    Stateful version of an algorithm, fed every datapoint of the timeseries
+    through update() and called like the algorithm to answer in O(1) for the
+    whole timeseries so far.
+    """
+
+    # The algorithm it replaces, as a staticmethod
+    function = None
+
+    def __init__(self):
+        self.__name__ = self.function.__name__
+
+    def update(self, timestamp, value):
+        raise NotImplementedError
+
+    def __call__(self, timeseries, debug, debug_path):
+        raise NotImplementedError
+
+    def exceeds(self, statistic, threshold, scale, timeseries, debug, debug_path):
+        """
+        @return  statistic > threshold, decided by the original algorithm when
+                 they are within NEAR_TIE of the scale of the values.
+        """
+        if abs(statistic - threshold) <= NEAR_TIE * scale:
+            return self.function(timeseries, debug, debug_path)
+        return statistic > threshold
+
+
+class StreamingStddevFromAverage(StreamingAlgorithm):
+    """
+    stddev_from_average() on running moments.
+    """
+
+    function = staticmethod(stddev_from_average)
+
+    def __init__(self):
+        super(StreamingStddevFromAverage, self).__init__()
+        self.moments = RunningMoments()
+
+    def update(self, timestamp, value):
+        self.moments.add(value)
+
+    def __call__(self, timeseries, debug, debug_path):
+        try:
+            mean = self.moments.get_mean()
+            stdDev = self.moments.get_std()
+            t = tail_avg(timeseries, debug, debug_path)
+
+            return self.exceeds(abs(t - mean), 3 * stdDev, abs(t) + abs(mean) + 3 * stdDev,
+                                timeseries, debug, debug_path)
+        except:
+            if debug:
+                trace = traceback.format_exc()
+                errorline = 'error in stddev_from_average - %s\n' % str(trace)
+                with open(debug_path + '/nab.earthgecko_skyline.algorithm.errors.txt', 'a') as errorfile:
+                    errorfile.write(errorline)
+            return None
+
+
+class StreamingMeanSubtractionCumulation(StreamingAlgorithm):
+    """
+    mean_subtraction_cumulation() on the running moments of all but the
+    latest datapoint.
+    """
+
+    function = staticmethod(mean_subtraction_cumulation)
+
+    def __init__(self):
+        super(StreamingMeanSubtractionCumulation, self).__init__()
+        self.moments = RunningMoments()
+        self.latest = None
+
+    def update(self, timestamp, value):
+        if self.latest is not None:
+            self.moments.add(self.latest)
+        self.latest = value if value else 0
+
+    def __call__(self, timeseries, debug, debug_path):
+        try:
+            mean = self.moments.get_mean()
+            stdDev = self.moments.get_std()
+            latest = self.latest - mean
+
+            return self.exceeds(abs(latest), 3 * stdDev,
+                                abs(self.latest) + abs(mean) + 3 * stdDev,
+                                timeseries, debug, debug_path)
+        except:
+            if debug:
+                trace = traceback.format_exc()
+                errorline = 'error in mean_subtraction_cumulation - %s\n' % str(trace)
+                with open(debug_path + '/nab.earthgecko_skyline.algorithm.errors.txt', 'a') as errorfile:
+                    errorfile.write(errorline)
+            return None
+
+
+class StreamingLeastSquares(StreamingAlgorithm):
+    """
+    least_squares() in closed form, on the running co-moments of the
+    timestamps and values and on the last three datapoints.
+
+    np.linalg.lstsq drops the smaller singular value of the [x, 1] design
+    matrix when it is under lstsq_rcond() of the larger one. This is the case
+    of epoch timestamps a few minutes apart, whose fit is then the minimum
+    norm solution along the larger singular vector instead of the regression
+    line. Both fits are computed from the same moments.
+    """
+
+    function = staticmethod(least_squares)
+
+    def __init__(self):
+        super(StreamingLeastSquares, self).__init__()
+        self.count = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+        self.syy = 0.0
+        self.tail = deque(maxlen=3)
+        # The moments of a NaN or infinite value are meaningless
+        self.finite = True
+
+    def update(self, timestamp, value):
+        x = float(timestamp)
+        y = float(value)
+        if not (np.isfinite(x) and np.isfinite(y)):
+            self.finite = False
+        self.tail.append((x, y))
+
+        self.count += 1
+        dx = x - self.mean_x
+        self.mean_x += dx / self.count
+        dy = y - self.mean_y
+        self.mean_y += dy / self.count
+        self.sxx += dx * (x - self.mean_x)
+        self.sxy += dx * (y - self.mean_y)
+        self.syy += dy * (y - self.mean_y)
+
+    def fit(self):
+        """
+        @return  (m, c) of np.linalg.lstsq, None when too close to its rank
+                 cutoff to tell which fit it makes.
+        """
+        n = self.count
+        mean_x, mean_y = self.mean_x, self.mean_y
+
+        # Eigenvalues of the Gram matrix [[sum x^2, sum x], [sum x, n]], the
+        # squared singular values of [x, 1]. The smaller one comes from the
+        # determinant n * sxx, which the raw sums would cancel out.
+        a = self.sxx + n * mean_x * mean_x
+        b = n * mean_x
+        largest = (a + n) / 2 + math.hypot((a - n) / 2, b)
+        smallest = n * self.sxx / largest
+
+        ratio = math.sqrt(smallest / largest) / lstsq_rcond(n)
+        if abs(ratio - 1) < NEAR_RANK_CUTOFF:
+            return None
+        if ratio > 1:
+            m = self.sxy / self.sxx
+            return m, mean_y - m * mean_x
+
+        # Projection of y on the larger singular vector, the best conditioned
+        # of the two eigenvector formulas
+        vx, vc = largest - n, b
+        if math.hypot(vx, vc) < math.hypot(b, largest - a):
+            vx, vc = b, largest - a
+        norm = math.hypot(vx, vc)
+        vx, vc = vx / norm, vc / norm
+        projection = (vx * (self.sxy + n * mean_x * mean_y) + vc * n * mean_y) / largest
+        return projection * vx, projection * vc
+
+    def __call__(self, timeseries, debug, debug_path):
+        try:
+            if self.count < 3:
+                return False
+            fit = self.fit() if self.finite else None
+            if fit is None:
+                return self.function(timeseries, debug, debug_path)
+            m, c = fit
+
+            # Variance of the residuals y - (m * x + c) around their mean
+            std_dev = math.sqrt(max(self.syy - 2 * m * self.sxy + m * m * self.sxx, 0.0)
+                                / self.count)
+            errors = [value - (m * x + c) for x, value in self.tail]
+            t = (errors[-1] + errors[-2] + errors[-3]) / 3
+
+            near_tie = NEAR_TIE * (abs(m * self.tail[-1][0]) + abs(c) + abs(self.mean_y)
+                                   + 3 * std_dev + abs(t))
+            if (abs(abs(t) - std_dev * 3) <= near_tie or abs(std_dev - 0.5) <= near_tie
+                    or abs(abs(t) - 0.5) <= near_tie):
+                return self.function(timeseries, debug, debug_path)
+
+            return abs(t) > std_dev * 3 and round(std_dev) != 0 and round(t) != 0
+        except:
+            if debug:
+                trace = traceback.format_exc()
+                errorline = 'error in least_squares - %s\n' % str(trace)
+                with open(debug_path + '/nab.earthgecko_skyline.algorithm.errors.txt', 'a') as errorfile:
+                    errorfile.write(errorline)
+            return None
+
+
+# Streaming versions of the algorithms that would rescan the whole timeseries
+STREAMING_ALGORITHMS = {
+    stddev_from_average: StreamingStddevFromAverage,
+    mean_subtraction_cumulation: StreamingMeanSubtractionCumulation,
+    least_squares: StreamingLeastSquares,
+}
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from CADOSEDetector import (EVICTION_FRACTION, NEURON_FACT_OFFSET,
+                            ContextualAnomalyDetectorOSE)
+
+
+@pytest.mark.parametrize("series,policy", [
+    ("noise", "lru"), ("noise", "lfu"), ("walk", "lru"), ("walk", "lfu"),
+])
+def test_eviction_keeps_the_budget(series, policy):
+    rng = np.random.RandomState(0)
+    if series == "noise":
+        values, budget = rng.rand(400), 1000
+    else:
+        values, budget = np.cumsum(rng.randn(8000)), 300
+    cad = ContextualAnomalyDetectorOSE(values.min(), values.max(), restPeriod=30,
+                                       maxContexts=budget, evictionPolicy=policy)
+    operator = cad.contextOperator
+    evictContexts = operator.evictContexts
+    sweeps = []
+
+    def recordEviction():
+        numContexts = operator.getNumContexts()
+        evictedFacts = evictContexts()
+        if evictedFacts:
+            sweeps.append((numContexts, len(evictedFacts), operator.getNumContexts()))
+        return evictedFacts
+
+    operator.evictContexts = recordEviction
+    sizes = []
+    for value in values:
+        cad.getAnomalyScoreByValue(value)
+        sizes.append(operator.getNumContexts())
+
+    floor = int(budget * (1 - EVICTION_FRACTION))
+    assert len(sweeps) > 5
+    for numContexts, numEvicted, numKept in sweeps:
+        # Exactly the contexts chosen by the policy, no cascade
+        assert numEvicted == numContexts - floor
+        assert numKept == floor
+    assert max(sizes) <= budget
+    assert min(sizes[len(sizes) // 2:]) >= floor
+
+    # The ids of the evicted contexts are reused once their fact is dropped,
+    # so the context arrays stay close to the budget
+    assert len(operator.contextCounts) < 2 * budget
+    for contextID in operator.freeContextIDs:
+        assert NEURON_FACT_OFFSET + contextID not in operator.factsDics[0]
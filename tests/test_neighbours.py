@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from neighbours import KDTreeIndex, get_neighbour_index
+
+
+class BruteForceTree(object):
+    """
+    Stand-in for scipy's cKDTree, querying the exact neighbours by a scan.
+    """
+
+    def __init__(self, data):
+        self.data = np.array(data)
+
+    def query(self, x, k, eps=0):
+        distances = np.sqrt(((self.data - x) ** 2).sum(axis=1))
+        rows = np.argsort(distances, kind="stable")[:k]
+        return distances[rows], rows
+
+
+def brute_force_ncm(vectors, sigma, item, k):
+    diff = vectors - item
+    distances = np.einsum("ij,ij->i", np.dot(diff, sigma), diff)
+    return np.sort(distances)[:k].sum()
+
+
+def make_problem(seed=0, num_vectors=600, dim=19):
+    rng = np.random.RandomState(seed)
+    vectors = np.cumsum(rng.normal(size=(num_vectors, dim)), axis=1)
+    factor = rng.normal(size=(dim, dim))
+    sigma = np.linalg.inv(np.dot(factor.T, factor) + np.eye(dim))
+    return rng, vectors, sigma
+
+
+def get_scipy_index(eps=0.0):
+    pytest.importorskip("scipy")
+    return get_neighbour_index("kdtree", eps)
+
+
+@pytest.mark.parametrize("make_index", [
+    lambda: KDTreeIndex(tree_class=BruteForceTree),
+    get_scipy_index,
+], ids=["brute_force_tree", "scipy"])
+def test_exact_ncm_matches_brute_force(make_index):
+    rng, vectors, sigma = make_problem()
+    index = make_index()
+    index.build(vectors, sigma)
+
+    for step in range(200):
+        # Slide the indexed set like KnncadDetector, through several rebuilds
+        row = step % len(vectors)
+        vectors[row] = vectors[rng.randint(len(vectors))] + rng.normal(size=vectors.shape[1])
+        index.replace(row, vectors[row])
+        if step == 100:
+            sigma = sigma * 2
+            index.set_sigma(sigma)
+
+        item = vectors[rng.randint(len(vectors))] + rng.normal(size=vectors.shape[1])
+        assert index.ncm(item, 27) == pytest.approx(
+            brute_force_ncm(vectors, sigma, item, 27), rel=1e-9)
+
+
+def test_approximate_ncm_is_bounded():
+    rng, vectors, sigma = make_problem(seed=1)
+    eps = 0.5
+    index = get_scipy_index(eps)
+    index.build(vectors, sigma)
+
+    for _ in range(50):
+        item = vectors[rng.randint(len(vectors))] + rng.normal(size=vectors.shape[1])
+        exact = brute_force_ncm(vectors, sigma, item, 27)
+        assert exact * (1 - 1e-9) <= index.ncm(item, 27) <= exact * (1 + eps) ** 2
+
+
+def test_unknown_index():
+    with pytest.raises(ValueError):
+        get_neighbour_index("balltree")
@@ -0,0 +1,41 @@
+"""
+Scores of the detectors against the ones of the original implementations,
+stored in data/baseline_scores.npz for the first NUM_RECORDS records of
+Twitter_volume_AMZN with a probationary percent of 0.15.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from NABCorpus import DataFile
+from CADOSEDetector import ContextOSEDetector
+from KnnCadDetector import KnncadDetector
+from skyline.EarthGeckoSkylineDetector import EarthgeckoSkylineDetector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_PATH = os.path.join(ROOT, "data", "streams", "Twitter_volume_AMZN.csv")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                             "baseline_scores.npz")
+NUM_RECORDS = 3000
+
+
+def load_data_file(num_records):
+    data_file = DataFile(DATA_PATH)
+    data_file.data = data_file.data.iloc[:num_records].copy()
+    return data_file
+
+
+@pytest.mark.parametrize("detector_class", [
+    ContextOSEDetector, KnncadDetector, EarthgeckoSkylineDetector,
+])
+def test_scores_match_the_baseline(detector_class):
+    detector = detector_class(data_set=load_data_file(NUM_RECORDS),
+                              probationary_percent=0.15)
+    detector.initialize()
+    results = detector.run()
+
+    with np.load(BASELINE_PATH) as baseline:
+        expected = baseline[detector_class.__name__]
+    np.testing.assert_array_equal(results["anomaly_score"].values.astype(float), expected)
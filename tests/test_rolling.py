@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from rolling import RankedWindow, SortedBlocks
+
+
+def naive_rank(values, value):
+    return sum(1 for other in values if other < value)
+
+
+@pytest.mark.parametrize("load", [1, 2, 16])
+def test_sorted_blocks_match_naive_rank(load):
+    rng = np.random.RandomState(load)
+    # Rounded so that the values hold duplicates
+    expected = list(np.round(rng.normal(size=100), 1))
+    blocks = SortedBlocks(expected, load=load)
+
+    for step in range(2000):
+        value = float(np.round(rng.normal(), 1))
+        assert blocks.rank(value) == naive_rank(expected, value)
+        if step % 2 == 0 or not expected:
+            blocks.add(value)
+            expected.append(value)
+        else:
+            removed = expected.pop(rng.randint(len(expected)))
+            blocks.remove(removed)
+        assert len(blocks) == len(expected)
+
+    with pytest.raises(ValueError):
+        blocks.remove(0.05)
+
+
+def test_ranked_window_matches_naive_rank():
+    rng = np.random.RandomState(0)
+    initial = list(np.round(rng.normal(size=1000), 1))
+    window = RankedWindow(initial)
+    expected = list(initial)
+
+    for step in range(3000):
+        value = float(np.round(rng.normal(), 1))
+        assert window.rank(value) == naive_rank(expected, value)
+        if step % 3 == 0 or not expected:
+            window.append(value)
+            expected.append(value)
+        elif step % 3 == 1:
+            assert window.popleft() == expected.pop(0)
+        else:
+            window.popleft()
+            expected.pop(0)
+            window.append(value)
+            expected.append(value)
+        assert len(window) == len(expected)
+    assert window.to_list() == expected
+
+
+def test_ranked_window_nan():
+    window = RankedWindow([1.0, float("nan"), 3.0])
+    window.append(float("nan"))
+    window.append(2.0)
+    # Like a comparison with NaN, a NaN score is never smaller
+    assert window.rank(10.0) == 3
+    assert window.rank(float("inf")) == 3
+    assert window.rank(float("nan")) == 0
+
+    window.popleft()
+    window.popleft()
+    assert window.rank(10.0) == 2
+    assert len(window.to_list()) == 3
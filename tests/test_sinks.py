@@ -0,0 +1,31 @@
+import numpy as np
+import pandas
+import pytest
+
+from sinks import get_sink, load_results
+
+
+def make_results(num_records):
+    rng = np.random.RandomState(0)
+    return pandas.DataFrame({
+        "timestamp": pandas.date_range("2015-02-26 21:42:53", periods=num_records,
+                                       freq="5min").astype("datetime64[ns]"),
+        "value": rng.rand(num_records) * 100,
+        "anomaly_score": rng.rand(num_records),
+        "label": rng.randint(0, 2, num_records).astype(np.int8),
+    }, columns=["timestamp", "value", "anomaly_score", "label"])
+
+
+@pytest.mark.parametrize("output_format", ["csv", "npy", "parquet"])
+def test_sink_round_trip(output_format, tmp_path):
+    if output_format == "parquet":
+        pytest.importorskip("pyarrow")
+    results = make_results(250)
+
+    with get_sink(str(tmp_path / "results.csv"), output_format) as sink:
+        for start in range(0, len(results), 100):
+            sink.write(results.iloc[start:start + 100])
+
+    loaded = load_results(sink.path, mmap_mode=None)
+    assert sink.num_records == len(results)
+    pandas.testing.assert_frame_equal(loaded, results, check_freq=False)
@@ -0,0 +1,30 @@
+import math
+
+import numpy as np
+import pytest
+
+from skyline.algorithms import StreamingLeastSquares, least_squares
+
+
+@pytest.mark.parametrize("offset", [-0.05, -0.002, 0.0, 0.002, 0.01, 0.05])
+def test_streaming_least_squares_near_the_rank_cutoff(offset):
+    # The singular value ratio of [x, 1] is about spacing / (sqrt(12) * x0^2),
+    # so this spacing puts it at offset of the rank cutoff of lstsq, growing
+    # with the number of datapoints
+    x0 = 1e9
+    spacing = x0 * x0 * np.finfo(float).eps * math.sqrt(12) * (1 + offset)
+    rng = np.random.RandomState(0)
+    timestamps = x0 + spacing * np.arange(300)
+    values = rng.randn(300) * 3 + 10
+    values[np.arange(300) % 50 >= 47] += 60
+
+    algorithm = StreamingLeastSquares()
+    timeseries = []
+    decisions = []
+    for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+        timeseries.append([timestamp, value])
+        algorithm.update(timestamp, value)
+        decision = least_squares(timeseries, False, None)
+        assert bool(algorithm(timeseries, False, None)) == bool(decision)
+        decisions.append(bool(decision))
+    assert any(decisions)
@@ -0,0 +1,43 @@
+import io
+
+import numpy as np
+import pytest
+
+from CADOSEDetector import ContextOSEDetector
+from KnnCadDetector import KnncadDetector
+from skyline.EarthGeckoSkylineDetector import EarthgeckoSkylineDetector
+from test_regression import load_data_file
+
+
+def make_detector(detector_class, data_file, streaming, initialize=True):
+    if streaming:
+        return detector_class(data_set=data_file, probationary_percent=0.15,
+                              streaming=True, probationary_period=300)
+    detector = detector_class(data_set=data_file, probationary_percent=0.15)
+    if initialize:
+        detector.initialize()
+    return detector
+
+
+@pytest.mark.parametrize("detector_class", [
+    ContextOSEDetector, KnncadDetector, EarthgeckoSkylineDetector,
+])
+@pytest.mark.parametrize("streaming", [False, True], ids=["batch", "streaming"])
+@pytest.mark.parametrize("cut", [50, 600])
+def test_state_round_trip(detector_class, streaming, cut):
+    data_file = load_data_file(1000)
+    detector = make_detector(detector_class, data_file, streaming)
+    timestamps, values = detector.get_input_arrays()
+    expected = detector.process_batch(timestamps, values)
+
+    before = make_detector(detector_class, data_file, streaming)
+    scores = [before.process_batch(timestamps[:cut], values[:cut])]
+    state_file = io.BytesIO()
+    before.save_state(state_file)
+    state_file.seek(0)
+
+    after = make_detector(detector_class, data_file, streaming, initialize=False)
+    after.load_state(state_file)
+    scores.append(after.process_batch(timestamps[cut:], values[cut:]))
+
+    np.testing.assert_array_equal(np.vstack(scores), expected)
@@ -1,6 +1,8 @@
 import os
 import math
+import datetime
 import dateutil
+import numpy
 
 
 def make_dirs_exist(dir_name):
@@ -27,13 +29,41 @@ def create_path(path):
 
 def get_probation_period(probation_percent, file_length):
     """
-    Return the probationary period index.
+    Return the probationary period index. A file_length of None stands for an
+    unbounded stream.
     """
+    if file_length is None:
+        return probation_percent * 5000
     return min(
         math.floor(probation_percent * file_length),
         probation_percent * 5000)
 
 
+def get_probation_records(probation_period, timestamps):
+    """
+    Return the probationary period in records.
+
+    @param probation_period  (int or datetime.timedelta)  Probationary period in
+                             records, or in time. A time is converted with the
+                             median sampling interval of the timestamps.
+
+    @param timestamps        (numpy.ndarray)  datetime64 timestamps of the first
+                             records of the data.
+    """
+    if not isinstance(probation_period, datetime.timedelta):
+        return probation_period
+
+    epoch_ns = numpy.asarray(timestamps, dtype="datetime64[ns]").astype(numpy.int64)
+    intervals = numpy.diff(epoch_ns)
+    if len(intervals) == 0 or numpy.median(intervals) <= 0:
+        raise ValueError("Cannot convert the probationary period %s to records, "
+                         "the sampling interval of the data is unknown"
+                         % probation_period)
+
+    interval = numpy.median(intervals) / 1e9
+    return max(1, int(probation_period.total_seconds() / interval))
+
+
 def absolute_file_paths(directory):
     """
     Given directory, gets the absolute path of all files within.